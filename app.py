@@ -8,15 +8,32 @@ POE 自动生成工作流 (POE Workflow Automator)
 import io
 import os
 import re
+import json
 import copy
+import csv
 import datetime
-from typing import List, Optional
+import hashlib
+import threading
+import zipfile
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain, groupby
+from typing import TYPE_CHECKING, Iterator, List, Optional
 import streamlit as st
-from openai import AzureOpenAI
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from docx import Document
-from docx.shared import Pt, Inches, RGBColor, Cm
+from docx.shared import Pt, RGBColor, Cm
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
+from docx.text.paragraph import Paragraph
+from docx.text.run import Run
+from docx.oxml import OxmlElement, parse_xml
+from docx.oxml.ns import nsdecls, qn
+from lxml import etree
+
+if TYPE_CHECKING:
+    from openai import AzureOpenAI
 
 # ──────────────────────────────────────────────
 # 常量
@@ -28,6 +45,28 @@ INFRA_TEMPLATE_PATH = os.path.join(TEMPLATE_DIR, "Infra_template.docx")
 POV_TEMPLATE_PATH = os.path.join(TEMPLATE_DIR, "pov_template.docx.docx")
 MIGRATE_TEMPLATE_PATH = os.path.join(TEMPLATE_DIR, "AzureMigrateimporttemplate.csv")
 
+# 封面标题的段前间距（约等于模板正文中 8 个空段落的高度）
+COVER_TOP_SPACING = Cm(7)
+
+# LLM 调用遇到限流或瞬时错误时的最大重试次数（不含首次请求），可用 AZURE_OPENAI_MAX_RETRIES 覆盖
+OPENAI_MAX_RETRIES = 3
+
+# 单次请求超时（秒），可用 AZURE_OPENAI_TIMEOUT 覆盖；流式请求按相邻分片的间隔计算
+OPENAI_TIMEOUT = 600.0
+
+# 单次生成的 token 上限（含推理模型的推理 token）；文档实际输出远低于此值
+OPENAI_MAX_COMPLETION_TOKENS = 16384
+
+# 文档类 prompt 要求模型在正文结束后输出的结束标记；流式读到即断开，结果中不保留
+END_MARKER = "---END---"
+
+# 相同 prompt 的生成结果在进程内缓存的时长（秒）与条数上限；点击「重新生成」时跳过缓存
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+RESPONSE_CACHE_MAX_ENTRIES = 128
+
+# .docx 字节（及其正文 XML）的缓存时长（秒）：会话结束后不再需要，到期即释放内存
+DOWNLOAD_CACHE_TTL = 60 * 60
+
 # 中文字体名称
 CN_FONT = "微软雅黑"
 CN_FONT_ALT = "Microsoft YaHei UI"
@@ -101,6 +140,45 @@ st.markdown(
 )
 
 
+# ──────────────────────────────────────────────
+# 后台线程池
+# ──────────────────────────────────────────────
+@st.cache_resource(show_spinner=False)
+def _worker_pool() -> ThreadPoolExecutor:
+    """
+    进程级共享线程池，只用于模板解析、docx 构建等短时 CPU / IO 任务。
+    页面渲染会同步等待这些任务，因此不要把耗时的网络请求放进来。
+    """
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="poe-worker")
+
+
+@st.cache_resource(show_spinner=False)
+def _llm_pool() -> ThreadPoolExecutor:
+    """进程级 LLM 请求线程池：单次调用可能持续数分钟，与短任务池隔开，占满时也不会卡住页面渲染。"""
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="poe-llm")
+
+
+def _with_script_ctx(fn, args, kwargs):
+    """包装任务，让工作线程继承当前脚本上下文（st.cache_* / st.secrets 依赖它）。"""
+    ctx = get_script_run_ctx()
+
+    def _run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+
+    return _run
+
+
+def _submit(fn, *args, **kwargs) -> Future:
+    """将短时任务提交到后台线程池。"""
+    return _worker_pool().submit(_with_script_ctx(fn, args, kwargs))
+
+
+def _submit_llm(fn, *args, **kwargs) -> Future:
+    """将 LLM / 网络请求提交到独立的线程池。"""
+    return _llm_pool().submit(_with_script_ctx(fn, args, kwargs))
+
+
 # ──────────────────────────────────────────────
 # 检查 Secrets 配置
 # ──────────────────────────────────────────────
@@ -126,64 +204,392 @@ def check_secrets() -> bool:
 # ──────────────────────────────────────────────
 # Azure OpenAI 客户端
 # ──────────────────────────────────────────────
-def get_openai_client() -> AzureOpenAI:
-    """创建 Azure OpenAI 客户端实例。"""
+def get_openai_client() -> "AzureOpenAI":
+    """返回 Azure OpenAI 客户端实例（按当前密钥配置复用，密钥变更后自动新建）。"""
+    return _openai_client(
+        st.secrets["AZURE_OPENAI_KEY"],
+        st.secrets["AZURE_OPENAI_ENDPOINT"],
+        st.secrets.get("AZURE_OPENAI_API_VERSION", "2024-06-01"),
+        int(st.secrets.get("AZURE_OPENAI_MAX_RETRIES", OPENAI_MAX_RETRIES)),
+        float(st.secrets.get("AZURE_OPENAI_TIMEOUT", OPENAI_TIMEOUT)),
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def _openai_client(api_key: str, endpoint: str, api_version: str,
+                   max_retries: int, timeout: float) -> "AzureOpenAI":
+    """
+    创建 Azure OpenAI 客户端（进程级缓存，以密钥配置为键）。
+    SDK 自带的 httpx 客户端已启用连接池与 keep-alive，跨会话、跨请求复用 TCP/TLS 连接。
+    """
+    # 延迟导入：openai 会连带加载 httpx / pydantic 等，放到首次调用时可缩短冷启动
+    from openai import AzureOpenAI
+
     return AzureOpenAI(
-        api_key=st.secrets["AZURE_OPENAI_KEY"],
-        azure_endpoint=st.secrets["AZURE_OPENAI_ENDPOINT"],
-        api_version=st.secrets.get("AZURE_OPENAI_API_VERSION", "2024-06-01"),
+        api_key=api_key,
+        azure_endpoint=endpoint,
+        api_version=api_version,
+        # 429 / 408 / 5xx / 连接错误自动重试：指数退避 + 抖动，并遵循 Retry-After 头
+        max_retries=max_retries,
+        timeout=timeout,
+    )
+
+
+def _warm_up_deployment(deployment: str):
+    """
+    发送一次 1 token 的探活请求：提前建立 TLS 连接并唤醒部署，缩短用户首次点击生成的等待。
+    请求同样计入 RPM / TPM 限速；失败不影响正常调用：不重试、短超时、异常静默。
+    """
+    params = dict(
+        model=deployment,
+        messages=[{"role": "user", "content": "ping"}],
+        max_completion_tokens=1,
     )
+    try:
+        _wait_for_quota(params)
+        get_openai_client().with_options(max_retries=0, timeout=15.0).chat.completions.create(**params)
+    except Exception:
+        pass
+
+
+@st.cache_resource(show_spinner=False)
+def _warm_up_once(endpoint: str, deployment: str) -> Future:
+    """每个进程对同一部署只预热一次（进程级缓存，并发会话也只会提交一个请求）。"""
+    return _submit_llm(_warm_up_deployment, deployment)
+
+
+# ──────────────────────────────────────────────
+# 请求限速（多用户共享同一部署的 RPM / TPM 配额）
+# ──────────────────────────────────────────────
+class _RateLimiter:
+    """
+    60 秒滑动窗口限速器：窗口内请求数不超过 rpm、预估 token 之和不超过 tpm。
+    额度不足时阻塞等待最早一条记录滑出窗口；rpm / tpm 为 0 表示不限制该项。
+    """
+
+    def __init__(self, rpm: int, tpm: int, window: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._events = deque()  # (时间戳, 预估 token)
+        self._tokens = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, tokens: int):
+        # 单个请求的预估超过整个 TPM 时按 TPM 计，否则永远无法放行
+        if self.tpm:
+            tokens = min(tokens, self.tpm)
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= self.window:
+                    self._tokens -= self._events.popleft()[1]
+                if ((not self.rpm or len(self._events) < self.rpm)
+                        and (not self.tpm or self._tokens + tokens <= self.tpm)):
+                    self._events.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                self._cond.wait(self._events[0][0] + self.window - now)
+
+
+@st.cache_resource(show_spinner=False)
+def _rate_limiter(rpm: int, tpm: int) -> _RateLimiter:
+    """所有会话共享的限速器（进程级单例，按配额参数区分）。"""
+    return _RateLimiter(rpm, tpm)
+
+
+def _wait_for_quota(params: dict):
+    """
+    按 secrets 中的 AZURE_OPENAI_RPM / AZURE_OPENAI_TPM 排队等待额度；均未配置时直接返回。
+    token 预估与 Azure 的配额计算方式一致：prompt 字符数 / 4 + max_completion_tokens × 候选数。
+    """
+    rpm = int(st.secrets.get("AZURE_OPENAI_RPM", 0))
+    tpm = int(st.secrets.get("AZURE_OPENAI_TPM", 0))
+    if not (rpm or tpm):
+        return
+    prompt_chars = sum(len(m["content"]) for m in params["messages"])
+    _rate_limiter(rpm, tpm).acquire(prompt_chars // 4 + params["max_completion_tokens"] * params.get("n", 1))
+
+
+# ──────────────────────────────────────────────
+# LLM 响应缓存（相同 prompt 直接复用已生成的结果）
+# ──────────────────────────────────────────────
+class _ResponseCache:
+    """带过期时间的进程级响应缓存，超出条数上限时淘汰最早写入的条目。"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # key -> (写入时间, 文本)，按写入顺序排列
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.ttl:
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def put(self, key: str, text: str):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic(), text)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+
+@st.cache_resource(show_spinner=False)
+def _response_cache() -> _ResponseCache:
+    """所有会话共享的响应缓存（进程级单例）。"""
+    return _ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _response_cache_key(system_prompt: str, user_prompt: str) -> str:
+    """
+    以部署名 + prompt 的摘要作为缓存键（prompt 可能含整份参考模板，不直接做键）。
+    计算前把连续空白折叠为一个空格：只差空格、换行（如粘贴时多出的空行、CRLF）的输入视为同一请求。
+    """
+    digest = hashlib.sha256()
+    for part in (st.secrets["AZURE_OPENAI_DEPLOYMENT"], system_prompt, user_prompt):
+        digest.update(_WHITESPACE_RE.sub(" ", part).strip().encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
 
 
 # ──────────────────────────────────────────────
 # LLM 调用封装
 # ──────────────────────────────────────────────
-def call_azure_openai(system_prompt: str, user_prompt: str) -> str:
-    """调用 Azure OpenAI Chat Completions API 并返回文本结果。"""
-    client = get_openai_client()
-    response = client.chat.completions.create(
+def _completion_params(system_prompt: str, user_prompt: str) -> dict:
+    """构造 Chat Completions 请求的公共参数。"""
+    return dict(
         model=st.secrets["AZURE_OPENAI_DEPLOYMENT"],
         messages=[
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
         ],
         temperature=0.7,
-        max_completion_tokens=128000,
+        max_completion_tokens=OPENAI_MAX_COMPLETION_TOKENS,
     )
-    content = response.choices[0].message.content
-    if not content or not content.strip():
+
+
+def _cut_at_end_marker(text: str) -> str:
+    """截掉结束标记及其后的内容（非流式结果）。"""
+    return text.split(END_MARKER, 1)[0]
+
+
+def call_azure_openai(system_prompt: str, user_prompt: str, use_cache: bool = True) -> str:
+    """
+    调用 Azure OpenAI Chat Completions API 并返回文本结果。
+    use_cache 为 True 时优先返回相同 prompt 的缓存结果；无论是否命中，新结果都会写入缓存。
+    """
+    key = _response_cache_key(system_prompt, user_prompt)
+    if use_cache:
+        cached = _response_cache().get(key)
+        if cached is not None:
+            return cached
+    client = get_openai_client()
+    params = _completion_params(system_prompt, user_prompt)
+    _wait_for_quota(params)
+    response = client.chat.completions.create(**params)
+    content = _cut_at_end_marker(response.choices[0].message.content or "")
+    if not content.strip():
         raise ValueError(
             f"API 返回了空内容。finish_reason={response.choices[0].finish_reason}"
         )
+    _response_cache().put(key, content)
     return content
 
 
+def call_azure_openai_choices(system_prompt: str, user_prompt: str, n: int) -> List[str]:
+    """一次请求生成 n 个候选（输入 token 只计费一次），返回各候选的非空文本。"""
+    client = get_openai_client()
+    params = dict(_completion_params(system_prompt, user_prompt), n=n)
+    _wait_for_quota(params)
+    response = client.chat.completions.create(**params)
+    drafts = [_cut_at_end_marker(c.message.content or "") for c in response.choices]
+    drafts = [d for d in drafts if d.strip()]
+    if not drafts:
+        raise ValueError(
+            f"API 返回了空内容。finish_reason={response.choices[0].finish_reason}"
+        )
+    return drafts
+
+
+def stream_azure_openai(system_prompt: str, user_prompt: str, use_cache: bool = True) -> Iterator[str]:
+    """
+    流式调用 Chat Completions API，逐段产出文本（配合 st.write_stream 实时渲染）。
+    命中缓存时一次性产出缓存结果；完整读完的流式结果写入缓存（中途放弃的不写入）。
+    """
+    key = _response_cache_key(system_prompt, user_prompt)
+    if use_cache:
+        cached = _response_cache().get(key)
+        if cached is not None:
+            yield cached
+            return
+    parts = []
+    for text in _stream_completion(system_prompt, user_prompt):
+        parts.append(text)
+        yield text
+    _response_cache().put(key, "".join(parts))
+
+
+def _stream_completion(system_prompt: str, user_prompt: str) -> Iterator[str]:
+    """发起流式请求并逐段产出文本，读到结束标记即断开连接。"""
+    client = get_openai_client()
+    params = _completion_params(system_prompt, user_prompt)
+    _wait_for_quota(params)
+    response = client.chat.completions.create(**params, stream=True)
+    finish_reason = None
+    has_content = False
+    # 末尾保留一段可能是结束标记前缀的文本，确认不是标记后再输出
+    pending = ""
+    keep = len(END_MARKER) - 1
+    for chunk in response:
+        # Azure 的首个分片可能只携带内容过滤结果，没有 choices
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        finish_reason = choice.finish_reason or finish_reason
+        text = choice.delta.content if choice.delta else None
+        if not text:
+            continue
+        pending += text
+        idx = pending.find(END_MARKER)
+        if idx != -1:
+            # 读到结束标记：提前关闭连接，不再等待模型收尾
+            pending = pending[:idx]
+            response.close()
+            break
+        if len(pending) > keep:
+            text, pending = pending[:-keep], pending[-keep:]
+            has_content = has_content or bool(text.strip())
+            yield text
+    if pending:
+        has_content = has_content or bool(pending.strip())
+        yield pending
+    if not has_content:
+        raise ValueError(f"API 返回了空内容。finish_reason={finish_reason}")
+
+
+# ──────────────────────────────────────────────
+# Batch API（异步批处理，费用约为实时调用的一半）
+# ──────────────────────────────────────────────
+def batch_mode_available() -> bool:
+    """是否配置了 Global Batch 部署（AZURE_OPENAI_BATCH_DEPLOYMENT）。"""
+    return "AZURE_OPENAI_BATCH_DEPLOYMENT" in st.secrets
+
+
+def submit_batch_job(requests: dict) -> str:
+    """
+    将 {custom_id: (system_prompt, user_prompt)} 打包为 JSONL 上传，
+    创建 24 小时完成窗口的 Batch 任务并返回 batch_id。
+    """
+    client = get_openai_client()
+    lines = []
+    for custom_id, (system_prompt, user_prompt) in requests.items():
+        body = _completion_params(system_prompt, user_prompt)
+        body["model"] = st.secrets["AZURE_OPENAI_BATCH_DEPLOYMENT"]
+        lines.append(json.dumps(
+            {"custom_id": custom_id, "method": "POST", "url": "/chat/completions", "body": body},
+            ensure_ascii=False,
+        ))
+    batch_file = client.files.create(
+        file=("poe_batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+
+def fetch_batch_results(batch_id: str) -> tuple:
+    """查询 Batch 任务，返回 (status, {custom_id: 文本})；未完成时结果为空。"""
+    client = get_openai_client()
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != "completed" or not batch.output_file_id:
+        return batch.status, {}
+    results = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        body = (item.get("response") or {}).get("body") or {}
+        choices = body.get("choices") or []
+        content = _cut_at_end_marker(choices[0]["message"].get("content") or "") if choices else ""
+        if content.strip():
+            results[item["custom_id"]] = content
+    return batch.status, results
+
+
 # ──────────────────────────────────────────────
 # 模板文本提取（用于注入 AI Prompt）
 # ──────────────────────────────────────────────
-@st.cache_data
-def extract_template_text(path: str) -> str:
-    """从 .docx 模板文件中提取所有文本内容（含表格），用于注入 AI prompt。"""
+@st.cache_data(persist="disk", show_spinner=False)
+def extract_template_text(path: str, mtime: float, size: int) -> str:
+    """
+    从 .docx 模板文件中提取所有文本内容（含表格），用于注入 AI prompt。
+    mtime / size 参与缓存键：模板被替换后自动失效（即使复制时保留了修改时间）；
+    结果持久化到磁盘，进程重启后仍可命中。
+    """
     doc = Document(path)
-    lines = []
-    for p in doc.paragraphs:
-        text = p.text.strip()
-        if text:
-            lines.append(text)
-    for table in doc.tables:
-        header_cells = [cell.text.strip() for cell in table.rows[0].cells]
-        lines.append("| " + " | ".join(header_cells) + " |")
-        lines.append("| " + " | ".join(["---"] * len(header_cells)) + " |")
-        for row in table.rows[1:]:
-            cells = [cell.text.strip().replace("\n", " ") for cell in row.cells]
-            lines.append("| " + " | ".join(cells) + " |")
-        lines.append("")
-    return "\n".join(lines)
+    paragraphs = (text for text in (p.text.strip() for p in doc.paragraphs) if text)
+    tables = chain.from_iterable(_table_text_lines(t) for t in doc.tables)
+    return "\n".join(chain(paragraphs, tables))
+
+
+# 含合并单元格或行首/行尾空位的表格，需按网格展开单元格，交给 python-docx 处理
+_TABLE_GRID_TAGS = tuple(qn(t) for t in ("w:gridSpan", "w:vMerge", "w:gridBefore", "w:gridAfter"))
+
+
+def _table_text_lines(table) -> Iterator[str]:
+    """逐行产出 Word 表格的 Markdown 文本（表头、分隔行、数据行，末尾一个空行）。"""
+    tbl = table._tbl
+    if next(tbl.iter(*_TABLE_GRID_TAGS), None) is not None:
+        rows = ([cell.text for cell in row.cells] for row in table.rows)
+    else:
+        # 规则表格直接遍历 <w:tr>/<w:tc>：table.rows / row.cells 每次都会重建整张单元格网格
+        rows = (["\n".join(p.text for p in tc.p_lst) for tc in tr.tc_lst] for tr in tbl.tr_lst)
+    header = next(rows, None)
+    if header is None:
+        return
+    pipe_join = " | ".join
+    header_cells = [text.strip() for text in header]
+    yield "| " + pipe_join(header_cells) + " |"
+    yield "| " + pipe_join(["---"] * len(header_cells)) + " |"
+    for row in rows:
+        yield "| " + pipe_join([text.strip().replace("\n", " ") for text in row]) + " |"
+    yield ""
+
+
+def load_template_refs(*paths: str) -> List[str]:
+    """并行提取多份参考模板文本（互不依赖）；模板缺失时返回空串。"""
+    futures = []
+    for p in paths:
+        if os.path.exists(p):
+            stat = os.stat(p)
+            futures.append(_submit(extract_template_text, p, stat.st_mtime, stat.st_size))
+        else:
+            futures.append(None)
+    return [f.result() if f is not None else "" for f in futures]
 
 
 # ──────────────────────────────────────────────
 # Prompt 模板
 # ──────────────────────────────────────────────
+# 追加到文档类 prompt 末尾：写完最后一章后输出结束标记
+END_MARKER_INSTRUCTION = (
+    f"\n\n**结束标记：** 最后一个章节写完后，单独输出一行 `{END_MARKER}`，之后不要再输出任何内容。"
+)
+
 SOLUTION_SYSTEM_PROMPT = (
     "你是一位顶级的 Microsoft Azure AI 解决方案架构师。"
     "请根据用户提供的【客户名称】和【背景信息】，生成一份完整、专业的 AI 售前解决方案架构文档。\n\n"
@@ -246,6 +652,7 @@ SOLUTION_SYSTEM_PROMPT = (
     "- 内容要精炼简洁，严格对齐参考模板的篇幅，不要更长\n"
     "- 表格必须使用 Markdown 表格语法\n\n"
     "**重要：** 下方会提供一份【参考模板文档】，你必须严格学习它的写作风格（段落叙述，非列表）、内容篇幅和表格格式。以完全相同的结构和风格为新客户生成内容。"
+    + END_MARKER_INSTRUCTION
 )
 
 INFRA_SYSTEM_PROMPT = (
@@ -303,6 +710,7 @@ INFRA_SYSTEM_PROMPT = (
     "- 内容要精炼简洁，严格对齐参考模板的篇幅，不要更长\n"
     "- 表格必须使用 Markdown 表格语法\n\n"
     "**重要：** 下方会提供一份【参考模板文档】，你必须严格学习它的写作风格（段落叙述，非列表）、内容篇幅和表格格式。以完全相同的结构和风格为新客户生成内容。"
+    + END_MARKER_INSTRUCTION
 )
 
 POV_SYSTEM_PROMPT = (
@@ -340,6 +748,7 @@ POV_SYSTEM_PROMPT = (
     
     "每天的任务必须具体、可操作。里程碑与交付物是具体产出（例如 '部署日志'、'准确率报告'、'UAT 签字单'）。\n\n"
     "**重要：** 下方会提供一份【参考模板文档】，你必须严格学习它的章节结构、分阶段格式、表格详细度和交付物命名规范。内容风格要精炼简洁，与模板保持一致。"
+    + END_MARKER_INSTRUCTION
 )
 
 # -----------------------------------------------------------------
@@ -375,36 +784,67 @@ CSV_SYSTEM_PROMPT = (
 # ──────────────────────────────────────────────
 # Word 文档生成 —— 通用工具函数
 # ──────────────────────────────────────────────
-def _set_run_font(run, font_name=CN_FONT, size_pt=None, bold=None, color_rgb=None):
-    """为 run 设置字体（含中文 eastAsia 字体）。"""
+_EAST_ASIA_ATTR = qn("w:eastAsia")
+
+
+@lru_cache(maxsize=None)
+def _run_props_prototype(font_name, size_pt, bold, color_rgb):
+    """按 (字体, 字号, 加粗, 颜色) 构建一次 <w:rPr> 原型，之后每个 run 只需深拷贝。"""
+    run = Run(OxmlElement("w:r"), None)
     run.font.name = font_name
     # python-docx 需要同时设置 eastAsia 字体才能在 Word 中正确显示中文
-    run._element.rPr.rFonts.set(qn("w:eastAsia"), font_name)
+    run._element.rPr.rFonts.set(_EAST_ASIA_ATTR, font_name)
     if size_pt is not None:
         run.font.size = Pt(size_pt)
     if bold is not None:
         run.bold = bold
     if color_rgb is not None:
         run.font.color.rgb = color_rgb
+    return run._element.rPr
+
+
+def _set_run_font(run, font_name=CN_FONT, size_pt=None, bold=None, color_rgb=None):
+    """为新建的 run 设置字体（含中文 eastAsia 字体）。"""
+    r = run._element
+    if r.rPr is not None:
+        r.remove(r.rPr)
+    r.insert(0, copy.deepcopy(_run_props_prototype(font_name, size_pt, bold, color_rgb)))
+
+
+# 行内加粗分词：** 定界符，或一段不含 ** 的文字（与 text.split("**") 的切分一致）
+_BOLD_TOKEN_RE = re.compile(r"\*\*|((?:[^*]+|\*(?!\*))+)")
+
+
+@lru_cache(maxsize=None)
+def _paragraph_props_prototype(alignment, first_line_indent):
+    """按 (对齐方式, 是否首行缩进) 构建一次 <w:pPr> 原型；无需段落属性时返回 None。"""
+    if alignment is None and not first_line_indent:
+        return None
+    paragraph = Paragraph(OxmlElement("w:p"), None)
+    if alignment is not None:
+        paragraph.alignment = alignment
+    # 首行缩进（约 1 个 Tab = 0.74cm）
+    if first_line_indent:
+        paragraph.paragraph_format.first_line_indent = Cm(0.74)
+    return paragraph._p.pPr
 
 
 def _add_styled_paragraph(doc, text, font_name=CN_FONT, size_pt=9, bold=False,
                           color_rgb=None, alignment=None, indent=True):
     """添加一个带完整样式的段落。indent=True 时添加首行缩进。"""
     p = doc.add_paragraph()
-    if alignment is not None:
-        p.alignment = alignment
-    # 首行缩进（约 1 个 Tab = 0.74cm）
-    if indent and alignment is None:
-        p.paragraph_format.first_line_indent = Cm(0.74)
-    # 处理 **加粗** 和普通文字的混合
-    parts = text.split("**")
-    for i, part in enumerate(parts):
-        if not part:
+    p_pr = _paragraph_props_prototype(alignment, indent and alignment is None)
+    if p_pr is not None:
+        p._p.insert(0, copy.deepcopy(p_pr))
+    # 处理 **加粗** 和普通文字的混合：每遇到一个 ** 切换一次加粗状态
+    in_bold = False
+    for m in _BOLD_TOKEN_RE.finditer(text):
+        part = m.group(1)
+        if part is None:
+            in_bold = not in_bold
             continue
         run = p.add_run(part)
-        is_bold = bold or (i % 2 == 1)
-        _set_run_font(run, font_name=font_name, size_pt=size_pt, bold=is_bold,
+        _set_run_font(run, font_name=font_name, size_pt=size_pt, bold=bold or in_bold,
                        color_rgb=color_rgb)
     return p
 
@@ -418,6 +858,10 @@ def _add_styled_heading(doc, text, level=1):
     return heading
 
 
+# Markdown 表格的分隔行，如 |---|:---:|
+_TABLE_SEP_RE = re.compile(r"^\|[\s\-:|]+\|$")
+
+
 def _parse_markdown_table(lines: List[str]) -> Optional[List[List[str]]]:
     """
     尝试从 Markdown 行列表中解析表格。
@@ -432,23 +876,32 @@ def _parse_markdown_table(lines: List[str]) -> Optional[List[List[str]]]:
     rows = []
     for line in lines:
         stripped = line.strip()
-        if not stripped:
-            continue
-        # 跳过分隔行 |---|---|
-        if re.match(r"^\|[\s\-:|]+\|$", stripped):
+        # 跳过空行和分隔行 |---|---|
+        if not stripped or _TABLE_SEP_RE.match(stripped):
             continue
-        # 解析单元格
-        cells = [c.strip() for c in stripped.split("|")]
-        # 去掉首尾空元素（因为 | 在开头和结尾会产生空字符串）
-        if cells and cells[0] == "":
-            cells = cells[1:]
-        if cells and cells[-1] == "":
-            cells = cells[:-1]
-        if cells:
-            rows.append(cells)
+        # 解析单元格：开头/结尾的 | 会切出空元素，先按下标跳过再 strip，不再反复切片
+        parts = stripped.split("|")
+        lo = 1 if stripped[0] == "|" else 0
+        hi = len(parts) - 1 if stripped[-1] == "|" else len(parts)
+        if lo < hi:
+            rows.append([c.strip() for c in parts[lo:hi]])
     return rows if len(rows) >= 2 else None
 
 
+# 表格单元格内容原型：整段 <w:p> XML 预先构建一次，每个单元格深拷贝后只填文字
+_CELL_PARAGRAPH_XML = (
+    '<w:p %s><w:r><w:rPr>'
+    '<w:rFonts w:ascii="{font}" w:hAnsi="{font}" w:eastAsia="{font}"/>{bold}{color}'
+    '<w:sz w:val="18"/>'
+    '</w:rPr><w:t/></w:r></w:p>'
+) % nsdecls("w")
+_HEADER_CELL_P = parse_xml(_CELL_PARAGRAPH_XML.format(
+    font=CN_FONT, bold="<w:b/>", color='<w:color w:val="FFFFFF"/>'))
+_BODY_CELL_P = parse_xml(_CELL_PARAGRAPH_XML.format(
+    font=CN_FONT, bold='<w:b w:val="0"/>', color=""))
+_HEADER_CELL_SHADING = parse_xml('<w:shd %s w:fill="156082" w:val="clear"/>' % nsdecls("w"))
+
+
 def _add_word_table(doc, table_data: list[list[str]]):
     """将二维数组写入 Word 表格，应用专业样式。"""
     if not table_data:
@@ -458,30 +911,28 @@ def _add_word_table(doc, table_data: list[list[str]]):
     table = doc.add_table(rows=len(table_data), cols=num_cols)
     table.style = "Table Grid"
 
-    for ri, row_data in enumerate(table_data):
-        for ci, cell_text in enumerate(row_data):
-            if ci >= num_cols:
-                break
-            cell = table.cell(ri, ci)
-            cell.text = ""  # 清空默认段落文本
-            p = cell.paragraphs[0]
-            run = p.add_run(cell_text)
-            is_header = (ri == 0)
-            _set_run_font(
-                run,
-                font_name=CN_FONT,
-                size_pt=9,
-                bold=is_header,
-            )
+    # 新建的表格没有合并单元格，按行直接遍历 <w:tr>/<w:tc>，不经 table.cell() 逐格定位
+    for ri, (row_data, tr) in enumerate(zip(table_data, table._tbl.tr_lst)):
+        is_header = (ri == 0)
+        cell_p = _HEADER_CELL_P if is_header else _BODY_CELL_P
+        for cell_text, tc in zip(row_data, tr.tc_lst):
+            p = copy.deepcopy(cell_p)
+            p[0][-1].text = cell_text  # <w:p><w:r>…<w:t>
+            tc.clear_content()
+            tc.append(p)
             # 表头行背景色
             if is_header:
-                shading = cell._element.get_or_add_tcPr()
-                shading_elem = shading.makeelement(
-                    qn("w:shd"),
-                    {qn("w:fill"): "156082", qn("w:val"): "clear"},
-                )
-                shading.append(shading_elem)
-                run.font.color.rgb = RGBColor(255, 255, 255)
+                tc.get_or_add_tcPr().append(copy.deepcopy(_HEADER_CELL_SHADING))
+
+
+# Markdown 行类型识别：各分支按原有判断优先级排列，每行只需一次匹配
+_MD_LINE_RE = re.compile(
+    r"(?P<rule>(?:---|\*\*\*|___)\Z)"      # --- 分隔线
+    r"|(?P<hashes>#{1,4}) (?P<heading>.*)"  # # ~ #### 标题
+    r"|\*\*(?P<bold>.+)\*\*\Z"               # 独立的 **加粗行**
+    r"|(?P<table>(?!-)[^|]*\|)"             # 含 | 的行（表格起始）
+    r"|[-*] (?P<item>.*)"                    # 无序列表
+)
 
 
 def _markdown_to_docx(doc, markdown_text: str, body_size=9):
@@ -489,139 +940,188 @@ def _markdown_to_docx(doc, markdown_text: str, body_size=9):
     将 AI 返回的 Markdown 文本解析并写入 Word 文档。
     支持: 标题 (#/##/###)、列表 (-/*)、Markdown 表格、加粗 (**)、普通段落。
     """
-    lines = markdown_text.split("\n")
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        stripped = line.strip()
+    # 按「是否含 |」把相邻行分组：表格从组内某行开始，一直延续到该组末尾
+    for _, group in groupby(markdown_text.splitlines(), key=lambda line: "|" in line):
+        for line in group:
+            stripped = line.strip()
+
+            # 空行跳过
+            if not stripped:
+                continue
+
+            m = _MD_LINE_RE.match(stripped)
+            kind = m.lastgroup if m else None
+
+            # ── 跳过 --- 分隔线 ──
+            if kind == "rule":
+                continue
+
+            # ── 标题 ──
+            if kind == "heading":
+                _add_styled_heading(doc, m.group("heading"), level=len(m.group("hashes")))
+
+            # ── 独立的 **加粗行**（如阶段标题），转为三级标题 ──
+            elif kind == "bold":
+                _add_styled_heading(doc, m.group("bold"), level=3)
+
+            # ── Markdown 表格 ──
+            elif kind == "table":
+                # 同组剩余行都含 |，即整张表格的其余部分
+                table_lines = [line, *group]
+                table_data = _parse_markdown_table(table_lines)
+                if table_data:
+                    _add_word_table(doc, table_data)
+                    doc.add_paragraph()  # 表格后空行
+                else:
+                    # 不是表格，作为普通文本处理
+                    for tl in table_lines:
+                        _add_styled_paragraph(doc, tl.strip(), size_pt=body_size)
 
-        # 空行跳过
-        if not stripped:
-            i += 1
-            continue
+            # ── 无序列表 ──
+            elif kind == "item":
+                _add_styled_paragraph(doc, f"•  {m.group('item')}", size_pt=body_size)
 
-        # ── 跳过 --- 分隔线 ──
-        if stripped == '---' or stripped == '***' or stripped == '___':
-            i += 1
-            continue
+            # ── 有序列表 / 普通段落（原样输出） ──
+            else:
+                _add_styled_paragraph(doc, stripped, size_pt=body_size)
 
-        # ── 标题 ──
-        if stripped.startswith("#### "):
-            _add_styled_heading(doc, stripped[5:], level=4)
-            i += 1
-            continue
-        if stripped.startswith("### "):
-            _add_styled_heading(doc, stripped[4:], level=3)
-            i += 1
-            continue
-        if stripped.startswith("## "):
-            _add_styled_heading(doc, stripped[3:], level=2)
-            i += 1
-            continue
-        if stripped.startswith("# "):
-            _add_styled_heading(doc, stripped[2:], level=1)
-            i += 1
-            continue
 
-        # ── 独立的 **加粗行**（如阶段标题），转为三级标题 ──
-        if stripped.startswith("**") and stripped.endswith("**") and len(stripped) > 4:
-            title_text = stripped[2:-2]
-            _add_styled_heading(doc, title_text, level=3)
-            i += 1
-            continue
+# ──────────────────────────────────────────────
+# Word 文档生成 —— 基于模板
+# ──────────────────────────────────────────────
+def _template_mtime(template_path: str) -> float:
+    """模板文件的修改时间，作为各级模板缓存的版本键；文件不存在时返回 0。"""
+    try:
+        return os.path.getmtime(template_path)
+    except OSError:
+        return 0.0
 
-        # ── Markdown 表格 ──
-        if "|" in stripped and not stripped.startswith("-"):
-            table_lines = []
-            while i < len(lines) and "|" in lines[i]:
-                table_lines.append(lines[i])
-                i += 1
-            table_data = _parse_markdown_table(table_lines)
-            if table_data:
-                _add_word_table(doc, table_data)
-                doc.add_paragraph()  # 表格后空行
-            else:
-                # 不是表格，作为普通文本处理
-                for tl in table_lines:
-                    _add_styled_paragraph(doc, tl.strip(), size_pt=body_size)
-            continue
 
-        # ── 无序列表 ──
-        if stripped.startswith("- ") or stripped.startswith("* "):
-            text = stripped[2:]
-            _add_styled_paragraph(doc, f"•  {text}", size_pt=body_size)
-            i += 1
-            continue
+@st.cache_resource(show_spinner=False)
+def _read_template_bytes(template_path: str, mtime: float) -> bytes:
+    """读取模板文件的原始字节（进程级缓存，只读共享；mtime 变化即重新读取）。"""
+    with open(template_path, "rb") as f:
+        return f.read()
 
-        # ── 有序列表 ──
-        if stripped[0].isdigit() and ". " in stripped[:5]:
-            _add_styled_paragraph(doc, stripped, size_pt=body_size)
-            i += 1
-            continue
 
-        # ── 普通段落 ──
-        _add_styled_paragraph(doc, stripped, size_pt=body_size)
-        i += 1
+# 模板正文中需要清除的顶层元素（段落、表格）
+_BODY_CONTENT_TAGS = frozenset((qn("w:p"), qn("w:tbl")))
+
+# 深拷贝期间禁止其他线程并发遍历同一份模板原型
+_TEMPLATE_COPY_LOCK = threading.Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def _template_skeleton(template_path: str, mtime: float):
+    """
+    加载模板并清空正文，返回其 OPC 包作为只读原型（进程级缓存，按 mtime 区分版本）。
+    保留样式定义、页面设置、页眉页脚。
+    """
+    doc = Document(io.BytesIO(_read_template_bytes(template_path, mtime)))
+    # 清空正文中的所有段落和表格：一次重建子节点列表，而不是逐个 remove
+    body = doc.element.body
+    body[:] = [child for child in body if child.tag not in _BODY_CONTENT_TAGS]
+    return doc.part.package
 
 
-# ──────────────────────────────────────────────
-# Word 文档生成 —— 基于模板
-# ──────────────────────────────────────────────
 def _load_template(template_path: str) -> Document:
     """
     加载 .docx 模板文件作为基础文档。
     如果模板不存在，则返回一个空白 Document。
+    每次深拷贝已清理的模板原型，省去 zip 解压与 XML 解析。
     """
     if os.path.exists(template_path):
-        doc = Document(template_path)
-        # 清空模板中的所有正文段落（保留样式定义、页面设置、页眉页脚）
-        for p in doc.paragraphs:
-            p._element.getparent().remove(p._element)
-        # 清空表格
-        for t in doc.tables:
-            t._element.getparent().remove(t._element)
-        return doc
+        skeleton = _template_skeleton(template_path, _template_mtime(template_path))
+        # 注意：需拷贝整个包而非 Document 对象——后者会把正文与 part 拷成两棵独立的树
+        with _TEMPLATE_COPY_LOCK:
+            package = copy.deepcopy(skeleton)
+        return package.main_document_part.document
     else:
         return Document()
 
 
-def _extract_title(content: str, fallback: str = "") -> str:
-    """从 AI 生成的 Markdown 内容中提取第一个 # 标题作为文档标题。"""
-    for line in content.split("\n"):
-        stripped = line.strip()
-        if stripped.startswith("# ") and not stripped.startswith("## "):
-            return stripped[2:].strip()
-    return fallback
+def _export_docx(doc, template_path: str) -> bytes:
+    """
+    将 Document 序列化为 .docx 字节。
+    生成过程只改动正文部件（document.xml），其余部件（样式、主题、页眉页脚、编号等）
+    直接从模板 zip 原样拷贝，不再经 python-docx 逐个重新序列化。
+    调用方直接 return 本函数结果，不再持有 Document 引用，XML 树随之可被回收；
+    BytesIO.getvalue() 直接交出内部缓冲，不会再多拷贝一份字节。
+    """
+    buffer = io.BytesIO()
+    if not os.path.exists(template_path):
+        doc.save(buffer)
+        return buffer.getvalue()
+
+    document_name = doc.part.partname[1:]  # 去掉开头的 "/"，即 zip 内路径
+    template_bytes = _read_template_bytes(template_path, _template_mtime(template_path))
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as src, \
+            zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            if info.filename == document_name:
+                dst.writestr(info, doc.part.blob)
+            else:
+                dst.writestr(info, src.read(info))
+    return buffer.getvalue()
 
 
-def _strip_first_heading(content: str) -> str:
-    """去掉 Markdown 内容中的第一个 # 标题行（因为封面已经显示了标题）。"""
-    lines = content.split("\n")
-    result = []
-    found = False
-    for line in lines:
-        stripped = line.strip()
-        if not found and stripped.startswith("# ") and not stripped.startswith("## "):
-            found = True
-            continue  # 跳过第一个 # 标题
-        result.append(line)
-    return "\n".join(result)
+@st.cache_data(show_spinner=False, max_entries=32, ttl=DOWNLOAD_CACHE_TTL)
+def _render_body_xml(template_path: str, template_mtime: float, markdown_text: str,
+                     body_size: int = 9) -> bytes:
+    """
+    将 Markdown 正文渲染为 <w:body> 子元素并序列化为 XML 字节。
+    渲染结果只取决于 (模板及其版本, 正文, 字号)，缓存后重复生成时只需重新拼接封面与目录。
+    需基于同一模板渲染，以便标题、表格样式解析到模板中的样式定义。
+    """
+    doc = _load_template(template_path)
+    _markdown_to_docx(doc, markdown_text, body_size=body_size)
+    wrapper = parse_xml("<w:body %s/>" % nsdecls("w"))
+    wrapper.extend([child for child in doc.element.body if child.tag in _BODY_CONTENT_TAGS])
+    return etree.tostring(wrapper)
+
+
+def _append_body_xml(doc, body_xml: bytes):
+    """将 _render_body_xml 的结果追加到文档正文末尾（sectPr 之前）。"""
+    body = doc.element.body
+    sect_pr = body.find(qn("w:sectPr"))
+    for child in list(parse_xml(body_xml)):
+        if sect_pr is not None:
+            sect_pr.addprevious(child)
+        else:
+            body.append(child)
+
+
+# 第一个一级标题行（与 line.strip().startswith("# ") 的判断一致），多数情况下就在首行
+_TITLE_LINE_RE = re.compile(r"^[^\S\n]*# [^\S\n]*(\S[^\n]*)", re.M)
+
+
+def _split_title_body(content: str, fallback: str = "") -> tuple:
+    """
+    一次查找拆出 (标题, 正文)：标题取第一个 # 标题行，正文为去掉该行后的内容
+    （封面已经显示了标题）。没有 # 标题时返回 (fallback, 原文)。
+    """
+    m = _TITLE_LINE_RE.search(content)
+    if not m:
+        return fallback, content
+    start, end = m.span()
+    # 连同该行的换行符一起去掉；若标题是最后一行，则去掉它前面的换行符
+    if end < len(content):
+        end += 1
+    elif start:
+        start -= 1
+    return m.group(1).rstrip(), content[:start] + content[end:]
 
 
 def _add_page_break(doc):
     """在文档中添加分页符。"""
-    from docx.oxml.ns import qn as _qn
     p = doc.add_paragraph()
     run = p.add_run()
-    br = run._element.makeelement(_qn("w:br"), {_qn("w:type"): "page"})
+    br = run._element.makeelement(qn("w:br"), {qn("w:type"): "page"})
     run._element.append(br)
 
 
 def _add_toc(doc):
     """插入 Word 目录域（用户打开文档后按 Ctrl+A → F9 即可更新）。"""
-    from docx.oxml.ns import qn as _qn
-    from docx.oxml import OxmlElement
-
     # 目录标题
     toc_title = doc.add_paragraph()
     toc_title.alignment = WD_ALIGN_PARAGRAPH.CENTER
@@ -634,16 +1134,16 @@ def _add_toc(doc):
     paragraph = doc.add_paragraph()
     run = paragraph.add_run()
     fldChar_begin = OxmlElement("w:fldChar")
-    fldChar_begin.set(_qn("w:fldCharType"), "begin")
+    fldChar_begin.set(qn("w:fldCharType"), "begin")
     run._element.append(fldChar_begin)
 
     instrText = OxmlElement("w:instrText")
-    instrText.set(_qn("xml:space"), "preserve")
+    instrText.set(qn("xml:space"), "preserve")
     instrText.text = ' TOC \\o "1-3" \\h \\z \\u '
     run._element.append(instrText)
 
     fldChar_separate = OxmlElement("w:fldChar")
-    fldChar_separate.set(_qn("w:fldCharType"), "separate")
+    fldChar_separate.set(qn("w:fldCharType"), "separate")
     run._element.append(fldChar_separate)
 
     # 占位文本（打开 Word 后会自动替换）
@@ -654,7 +1154,7 @@ def _add_toc(doc):
     run._element.append(placeholder)
 
     fldChar_end = OxmlElement("w:fldChar")
-    fldChar_end.set(_qn("w:fldCharType"), "end")
+    fldChar_end.set(qn("w:fldCharType"), "end")
     run._element.append(fldChar_end)
 
 
@@ -664,15 +1164,12 @@ def create_solution_docx(content: str, customer_name: str) -> bytes:
     布局: 封面标题（独占一页） → 目录（独占一页） → 正文
     """
     doc = _load_template(SOLUTION_TEMPLATE_PATH)
-    title = _extract_title(content, f"{customer_name} - AI 解决方案架构文档")
-    body_content = _strip_first_heading(content)
-
-    # ---- 第 1 页：封面标题 ----
-    for _ in range(8):
-        doc.add_paragraph()
+    title, body_content = _split_title_body(content, f"{customer_name} - AI 解决方案架构文档")
 
+    # ---- 第 1 页：封面标题（段前间距下推，代替多个空段落） ----
     cover = doc.add_paragraph()
     cover.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    cover.paragraph_format.space_before = COVER_TOP_SPACING
     run = cover.add_run(title)
     # 与模板一致: 18pt #4874CB
     _set_run_font(run, font_name=CN_FONT_ALT, size_pt=18,
@@ -688,12 +1185,11 @@ def create_solution_docx(content: str, customer_name: str) -> bytes:
     _add_page_break(doc)
 
     # ---- 第 3 页起：正文内容（已去掉第一个 # 标题） ----
-    _markdown_to_docx(doc, body_content, body_size=9)
+    body_xml = _render_body_xml(SOLUTION_TEMPLATE_PATH, _template_mtime(SOLUTION_TEMPLATE_PATH), body_content, body_size=9)
+    _append_body_xml(doc, body_xml)
 
     # 导出
-    buffer = io.BytesIO()
-    doc.save(buffer)
-    return buffer.getvalue()
+    return _export_docx(doc, SOLUTION_TEMPLATE_PATH)
 
 
 def create_pov_docx(content: str, customer_name: str) -> bytes:
@@ -702,15 +1198,12 @@ def create_pov_docx(content: str, customer_name: str) -> bytes:
     布局: 封面标题（独占一页） → 正文
     """
     doc = _load_template(POV_TEMPLATE_PATH)
-    title = _extract_title(content, f"{customer_name} - POV 部署计划")
-    body_content = _strip_first_heading(content)
-
-    # ---- 第 1 页：封面标题 ----
-    for _ in range(8):
-        doc.add_paragraph()
+    title, body_content = _split_title_body(content, f"{customer_name} - POV 部署计划")
 
+    # ---- 第 1 页：封面标题（段前间距下推，代替多个空段落） ----
     cover = doc.add_paragraph()
     cover.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    cover.paragraph_format.space_before = COVER_TOP_SPACING
     run = cover.add_run(title)
     # 与模板一致: 22pt #156082
     _set_run_font(run, font_name=CN_FONT_ALT, size_pt=22,
@@ -720,12 +1213,11 @@ def create_pov_docx(content: str, customer_name: str) -> bytes:
     _add_page_break(doc)
 
     # ---- 第 2 页起：正文内容（已去掉第一个 # 标题） ----
-    _markdown_to_docx(doc, body_content, body_size=9)
+    body_xml = _render_body_xml(POV_TEMPLATE_PATH, _template_mtime(POV_TEMPLATE_PATH), body_content, body_size=9)
+    _append_body_xml(doc, body_xml)
 
     # 导出
-    buffer = io.BytesIO()
-    doc.save(buffer)
-    return buffer.getvalue()
+    return _export_docx(doc, POV_TEMPLATE_PATH)
 
 
 def create_infra_docx(content: str, customer_name: str) -> bytes:
@@ -734,15 +1226,12 @@ def create_infra_docx(content: str, customer_name: str) -> bytes:
     布局: 封面标题（独占一页） → 目录（独占一页） → 正文
     """
     doc = _load_template(INFRA_TEMPLATE_PATH)
-    title = _extract_title(content, f"{customer_name} - 基础设施解决方案架构文档")
-    body_content = _strip_first_heading(content)
-
-    # ---- 第 1 页：封面标题 ----
-    for _ in range(8):
-        doc.add_paragraph()
+    title, body_content = _split_title_body(content, f"{customer_name} - 基础设施解决方案架构文档")
 
+    # ---- 第 1 页：封面标题（段前间距下推，代替多个空段落） ----
     cover = doc.add_paragraph()
     cover.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    cover.paragraph_format.space_before = COVER_TOP_SPACING
     run = cover.add_run(title)
     # 与 AI 解决方案一致: 18pt #4874CB
     _set_run_font(run, font_name=CN_FONT_ALT, size_pt=18,
@@ -758,12 +1247,368 @@ def create_infra_docx(content: str, customer_name: str) -> bytes:
     _add_page_break(doc)
 
     # ---- 第 3 页起：正文内容（已去掉第一个 # 标题） ----
-    _markdown_to_docx(doc, body_content, body_size=9)
+    body_xml = _render_body_xml(INFRA_TEMPLATE_PATH, _template_mtime(INFRA_TEMPLATE_PATH), body_content, body_size=9)
+    _append_body_xml(doc, body_xml)
 
     # 导出
-    buffer = io.BytesIO()
-    doc.save(buffer)
-    return buffer.getvalue()
+    return _export_docx(doc, INFRA_TEMPLATE_PATH)
+
+
+# session_state 中的文本键 → 对应的 .docx 生成函数
+DOCX_BUILDERS = {
+    "solution_text": create_solution_docx,
+    "infra_text": create_infra_docx,
+    "pov_text": create_pov_docx,
+}
+
+DOCX_TEMPLATES = {
+    "solution_text": SOLUTION_TEMPLATE_PATH,
+    "infra_text": INFRA_TEMPLATE_PATH,
+    "pov_text": POV_TEMPLATE_PATH,
+}
+
+
+@st.cache_data(show_spinner=False, max_entries=16, ttl=DOWNLOAD_CACHE_TTL)
+def _build_docx(key: str, content: str, customer_name: str, template_mtime: float) -> bytes:
+    """
+    构建 .docx（以文档类型、内容、客户名和模板版本为键缓存，页面重跑时不重复构建）。
+    这是成品字节唯一的一层缓存：create_*_docx 本身不缓存，模板更新后 template_mtime 变化即重新构建。
+    """
+    return DOCX_BUILDERS[key](content, customer_name)
+
+
+def _submit_docx_build(key: str, customer_name: str) -> Future:
+    """把 session_state[key] 对应文档的构建提交到后台线程池。"""
+    return _submit(_build_docx, key, st.session_state[key], customer_name,
+                   _template_mtime(DOCX_TEMPLATES[key]))
+
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+def _docx_download_button(jobs: dict, key: str, customer_name: str, deferred: list, **kwargs):
+    """
+    显示 .docx 下载按钮。后台构建已完成时直接显示；否则先放一个禁用的占位按钮，
+    记入 deferred，等页面其余部分渲染完后由 _flush_deferred_downloads 替换，不阻塞页面。
+    """
+    future = jobs.get(key)
+    if future is None:
+        # 本次未预先提交（如刚切换了文档类型）
+        future = jobs[key] = _submit_docx_build(key, customer_name)
+    if future.done():
+        _fill_docx_download(st, future, kwargs)
+        return
+    slot = st.empty()
+    slot.button(f"{kwargs['label']}（生成中…）", disabled=True,
+                use_container_width=kwargs.get("use_container_width", False))
+    deferred.append((slot, future, kwargs))
+
+
+def _fill_docx_download(container, future: Future, kwargs: dict):
+    """在 container 中放置下载按钮；构建失败时改为显示错误。"""
+    try:
+        data = future.result()
+    except Exception as e:
+        container.error(f"Word 文档生成失败：{e}")
+        return
+    container.download_button(data=data, mime=DOCX_MIME, **kwargs)
+
+
+def _flush_deferred_downloads(deferred: list):
+    """页面渲染完毕后，依次等待后台构建并把占位按钮替换为真正的下载按钮。"""
+    for slot, future, kwargs in deferred:
+        _fill_docx_download(slot, future, kwargs)
+
+
+# ──────────────────────────────────────────────
+# 辅助：拼接 user prompt
+# ──────────────────────────────────────────────
+REF_TEMPLATE_HEADING = "\n\n---\n\n## 【参考模板文档 —— 请学习其风格和结构，不要照抄具体数据】\n\n"
+
+
+def _join_prompt(parts: List[str], ref_text: str = "") -> str:
+    """将 prompt 各段一次性拼接；有参考模板文本时附在末尾。"""
+    if ref_text:
+        parts = [*parts, REF_TEMPLATE_HEADING, ref_text]
+    return "".join(parts)
+
+
+# ──────────────────────────────────────────────
+# 辅助：Batch 任务的提交与取回
+# ──────────────────────────────────────────────
+def _start_batch_job(target_key, system_prompt, user_ctx, customer_name, account_name, budget):
+    """提交单文档的 Batch 任务，并把任务信息记入 session_state。"""
+    st.session_state["batch_job"] = {
+        "id": submit_batch_job({target_key: (system_prompt, user_ctx)}),
+        "customer_name": customer_name,
+        "account_name": account_name.strip() if account_name.strip() else customer_name,
+        "budget": budget,
+    }
+
+
+def _render_batch_panel(customer_name, account_name, budget):
+    """显示 Batch 任务状态；也可粘贴任务 ID 恢复之前提交的任务。"""
+    job = st.session_state.get("batch_job", {})
+    with st.expander("批处理任务", expanded=bool(job)):
+        batch_id = st.text_input(
+            "任务 ID",
+            value=job.get("id", ""),
+            help="提交后可关闭页面，稍后凭此 ID 取回结果",
+        ).strip()
+        if not st.button("查询批处理结果", use_container_width=True,
+                         key="btn_batch_poll", disabled=not batch_id):
+            return
+        try:
+            with st.spinner("正在查询批处理任务..."):
+                status, results = fetch_batch_results(batch_id)
+        except Exception as e:
+            st.error(f"查询失败：{e}")
+            return
+        if not results:
+            if status in ("failed", "expired", "cancelled", "completed"):
+                st.error(f"任务未返回可用结果（状态：{status}）")
+            else:
+                st.info(f"任务尚未完成（状态：{status}），请稍后再查询。")
+            return
+        st.session_state.update(results)
+        cust = job.get("customer_name") or customer_name.strip() or "未命名客户"
+        st.session_state["customer_name"] = cust
+        st.session_state["account_name"] = job.get("account_name") or account_name.strip() or cust
+        st.session_state["budget"] = job.get("budget", budget)
+        st.session_state.pop("pov_text", None)
+        st.session_state.pop("batch_job", None)
+        st.rerun()
+
+
+# ──────────────────────────────────────────────
+# 辅助：多候选生成与选择
+# ──────────────────────────────────────────────
+DRAFT_COUNT = 2
+
+
+def _start_drafts(target_key, system_prompt, user_ctx, customer_name, account_name, budget):
+    """一次请求生成多个候选文档，记入 session_state 等待用户挑选。"""
+    with st.spinner(f"正在生成 {DRAFT_COUNT} 个候选..."):
+        drafts = call_azure_openai_choices(system_prompt, user_ctx, DRAFT_COUNT)
+    st.session_state["draft_job"] = {
+        "target_key": target_key,
+        "drafts": drafts,
+        "customer_name": customer_name,
+        "account_name": account_name.strip() if account_name.strip() else customer_name,
+        "budget": budget,
+    }
+
+
+def _render_draft_picker() -> Optional[str]:
+    """显示候选选择器；用户确认后写入对应文档。返回当前选中的候选文本供预览。"""
+    job = st.session_state["draft_job"]
+    drafts = job["drafts"]
+    choice = st.radio(
+        "选择候选",
+        range(len(drafts)),
+        format_func=lambda i: f"候选 {i + 1}",
+        horizontal=True,
+        key="draft_choice",
+    )
+    c_use, c_drop = st.columns(2)
+    with c_use:
+        if st.button("采用此候选", type="primary", use_container_width=True, key="btn_draft_use"):
+            st.session_state[job["target_key"]] = drafts[choice]
+            st.session_state["customer_name"] = job["customer_name"]
+            st.session_state["account_name"] = job["account_name"]
+            st.session_state["budget"] = job["budget"]
+            st.session_state.pop("pov_text", None)
+            st.session_state.pop("draft_job", None)
+            st.rerun()
+    with c_drop:
+        if st.button("放弃候选", use_container_width=True, key="btn_draft_drop"):
+            st.session_state.pop("draft_job", None)
+            st.rerun()
+    return drafts[choice]
+
+
+# ──────────────────────────────────────────────
+# 辅助：Azure Migrate CSV 生成
+# ──────────────────────────────────────────────
+def _read_migrate_csv_header() -> str:
+    """读取 Azure Migrate 导入模板的表头行；模板缺失时返回空串。"""
+    return _migrate_csv_header(MIGRATE_TEMPLATE_PATH, _template_mtime(MIGRATE_TEMPLATE_PATH))
+
+
+@st.cache_data(show_spinner=False)
+def _migrate_csv_header(path: str, mtime: float) -> str:
+    """按模板修改时间缓存表头行：页面重跑时只做一次 stat，模板更新后自动重新读取。"""
+    if not os.path.exists(path):
+        return ""
+    with open(path, "r", encoding="utf-8-sig") as f:
+        return f.readline().strip()
+
+
+def _sheet_markdown_lines(ws) -> Iterator[str]:
+    """逐行产出单个工作表的 Markdown 表格文本（标题、表头、分隔行、数据行），空表不产出。"""
+    rows = ws.iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        return
+    pipe_join = " | ".join
+    yield f"### Sheet: {ws.title}"
+    yield "| %s |" % pipe_join(["" if c is None else str(c) for c in header])
+    yield "| %s |" % pipe_join(["---"] * len(header))
+    for row in rows:
+        cells = ["" if c is None else str(c) for c in row]
+        # 定价计算器导出的表格下方常有上千行空行，不送进 prompt
+        if any(cells):
+            yield "| %s |" % pipe_join(cells)
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _price_sheet_markdown(file_bytes: bytes) -> str:
+    """将价格估算表的各工作表转为 Markdown 表格文本（以文件内容为键缓存，重复生成时跳过解析）。"""
+    import openpyxl
+    # 只读模式按行流式解析工作表 XML，不构建整张单元格 / 样式对象图
+    wb = openpyxl.load_workbook(io.BytesIO(file_bytes), data_only=True, read_only=True)
+    try:
+        return "\n".join(chain.from_iterable(_sheet_markdown_lines(ws) for ws in wb.worksheets))
+    finally:
+        wb.close()
+
+
+# 定价计算器中虚拟机的规格描述，如 "2 B2s (2 Cores, 4 GB RAM)"、"1 D4s v5 (4 vCPUs, 16 GB RAM)"
+_VM_SPEC_RE = re.compile(
+    r"(\d+)\s+([A-Za-z][\w ]*?)\s*\((\d+)\s*(?:v?CPUs?|v?Cores?),\s*(\d+(?:\.\d+)?)\s*GB RAM\)"
+)
+
+
+def _vm_spec_lines(excel_text: str) -> List[str]:
+    """
+    从价格表文本中直接解析出规格明确的虚拟机（数量、SKU、核数、内存），
+    作为确定值交给模型，不再让它从金额倒推。
+    """
+    return [
+        f"- {sku} × {count}：*Cores = {cores}，*Memory (In MB) = {round(float(mem_gb) * 1024)}"
+        for count, sku, cores, mem_gb in _VM_SPEC_RE.findall(excel_text)
+    ]
+
+
+def _build_csv_prompt(uploaded_excel, budget, migrate_csv_header: str) -> str:
+    """将价格估算表转为 Markdown 表格文本，拼成生成 Migrate CSV 的用户 prompt。"""
+    excel_text = _price_sheet_markdown(uploaded_excel.getvalue())
+    vm_lines = _vm_spec_lines(excel_text)
+    vm_text = (
+        "价格表中已明确规格的虚拟机（按数量各生成对应行，Cores / Memory 直接使用以下数值，不要倒推）：\n"
+        + "\n".join(vm_lines) + "\n\n"
+    ) if vm_lines else ""
+    return (
+        f"以下是客户的 Azure 价格估算表内容：\n\n{excel_text}\n\n"
+        f"{vm_text}"
+        f"客户预估年消耗：{budget}\n\n"
+        f"Azure Migrate CSV 模板表头：\n{migrate_csv_header}\n\n"
+        f"请根据价格估算表倒推本地 VM 配置，按模板格式生成 CSV。"
+    )
+
+
+# 首行的 ```（可带语言名，如 ```csv）与末尾的 ```
+_CSV_FENCE_RE = re.compile(r"\A```[^\n]*\n|\s*```\Z")
+
+
+def _clean_csv_output(csv_raw: str) -> str:
+    """去掉模型可能包裹的 ``` 代码块标记。"""
+    return _CSV_FENCE_RE.sub("", csv_raw.strip()).strip()
+
+
+def _csv_download_bytes(csv_data: str) -> bytes:
+    """下载用的 CSV 字节（带 BOM，Excel 可直接识别中文）；作为下载按钮的延迟数据，点击时才编码。"""
+    return csv_data.encode("utf-8-sig")
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def _csv_preview_frame(csv_data: str):
+    """
+    把生成的 CSV 解析成预览用 DataFrame（只有表头时返回 None）。
+    以 CSV 文本为键缓存同一个对象（不复制），其它控件触发的重跑不再重复解析；调用方只读不改。
+    """
+    header_line, _, body = csv_data.strip().partition("\n")
+    if not body:
+        return None
+    import pandas as pd
+    header = next(csv.reader([header_line]))
+    num_cols = len(header)
+    # C 解析器一次读完数据行；usecols 截断多余列，缺列补空串
+    df = pd.read_csv(
+        io.StringIO(body), header=None, names=range(num_cols), usecols=range(num_cols),
+        dtype=str, keep_default_na=False, skip_blank_lines=False, engine="c",
+    )
+    # 表头可能有重名列，读完后再设置列名
+    df.columns = header
+    return df
+
+
+def _stream_to_code(stream: Iterator[str], language: str, interval: float = 0.2) -> str:
+    """
+    把流式输出逐步渲染到代码块中并返回完整文本。
+    每次刷新都要重发整段文本，因此按 interval 秒节流，结束时再完整刷新一次。
+    """
+    placeholder = st.empty()
+    parts = []
+    last_render = 0.0
+    for text in stream:
+        parts.append(text)
+        now = time.monotonic()
+        if now - last_render >= interval:
+            placeholder.code("".join(parts), language=language)
+            last_render = now
+    result = "".join(parts)
+    placeholder.code(result, language=language)
+    return result
+
+
+@st.fragment(run_every=2)
+def _poll_csv_job():
+    """
+    轮询后台 CSV 任务：未完成时只重跑本 fragment 显示进度，
+    完成后写入结果（或错误信息）并整页刷新。
+    """
+    job = st.session_state.get("csv_job")
+    if job is None:
+        return
+    if not job.done():
+        st.info("Azure Migrate CSV 正在后台生成，可先切换到其它页面…")
+        return
+    del st.session_state["csv_job"]
+    try:
+        st.session_state["csv_code"] = _clean_csv_output(job.result())
+    except Exception as e:
+        st.session_state["csv_job_error"] = str(e)
+    st.rerun()
+
+
+# ──────────────────────────────────────────────
+# 辅助：分段渲染 Markdown 预览
+# ──────────────────────────────────────────────
+def _markdown_sections(markdown_text: str) -> List[str]:
+    """按二级标题（## ）把 Markdown 切成若干段，代码块内的同名行不作为切分点。"""
+    sections = []
+    current = []
+    in_fence = False
+    for line in markdown_text.splitlines(keepends=True):
+        if line.startswith("```"):
+            in_fence = not in_fence
+        elif not in_fence and line.startswith("## ") and current:
+            sections.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        sections.append("".join(current))
+    return sections
+
+
+def _render_markdown_preview(markdown_text: str):
+    """
+    逐章节渲染文档预览：每章一个 st.markdown 元素。
+    页面重跑时内容未变的章节前端直接复用，不必每次重新解析整篇长文档。
+    """
+    for section in _markdown_sections(markdown_text):
+        st.markdown(section, unsafe_allow_html=True)
 
 
 # ──────────────────────────────────────────────
@@ -774,6 +1619,190 @@ def _date_prefix():
     return datetime.date.today().strftime("%m%d")
 
 
+# ──────────────────────────────────────────────
+# 年度价格表（独立 fragment）
+# ──────────────────────────────────────────────
+def _col_letter(n):
+    """1 起始的列号转 Excel 列字母（1 → A，27 → AA）。"""
+    result = ""
+    while n:
+        n, rem = divmod(n - 1, 26)
+        result = chr(65 + rem) + result
+    return result
+
+
+def _copy_cell_style(src, dst):
+    """复制单元格的字体、填充、边框、对齐与数字格式。"""
+    if src.has_style:
+        dst.font      = copy.copy(src.font)
+        dst.fill      = copy.copy(src.fill)
+        dst.border    = copy.copy(src.border)
+        dst.alignment = copy.copy(src.alignment)
+        dst.number_format = src.number_format
+
+
+def _find_header_row(ws):
+    """返回含 Estimated monthly cost 的标题行行号，未找到时返回 None。"""
+    for i, row in enumerate(ws.iter_rows(values_only=True), 1):
+        if row and "Estimated monthly cost" in row:
+            return i
+    return None
+
+
+def _find_total_row(ws, hrow):
+    """返回标题行之后首个含 Total 的行号，未找到时返回 None。"""
+    for i, row in enumerate(ws.iter_rows(min_row=hrow + 1, values_only=True), hrow + 1):
+        if row and "Total" in row:
+            return i
+    return None
+
+
+def _get_account_name(ws):
+    """从 Sheet 第 2 行前 5 列取账号名（非空的第一个值）。"""
+    for col in range(1, 6):
+        v = ws.cell(2, col).value
+        if v and str(v).strip():
+            return str(v).strip().rstrip("\t").strip()
+    return None
+
+
+def _process_price_sheet(ws):
+    """在 Estimated upfront cost 右侧插入 Estimated yearly cost 列（月费用 × 12，Total 行求和）。返回 (成功, 说明, 账号名)。"""
+    from openpyxl.styles import Font as _Font
+
+    hrow = _find_header_row(ws)
+    if hrow is None:
+        return False, "未找到标题行（含 'Estimated monthly cost'）", None
+    trow = _find_total_row(ws, hrow)
+    if trow is None:
+        return False, "未找到 Total 行", None
+
+    header_vals = [ws.cell(hrow, c).value for c in range(1, ws.max_column + 1)]
+    try:
+        monthly_col = header_vals.index("Estimated monthly cost") + 1
+        upfront_col = header_vals.index("Estimated upfront cost") + 1
+    except ValueError:
+        return False, "未找到必要列名", None
+
+    yearly_col     = upfront_col + 1
+    ws.insert_cols(yearly_col)
+    monthly_letter = _col_letter(monthly_col)
+    yearly_letter  = _col_letter(yearly_col)
+
+    # 标题行：复制 upfront 列样式
+    hcell = ws.cell(hrow, yearly_col, "Estimated yearly cost")
+    _copy_cell_style(ws.cell(hrow, upfront_col), hcell)
+    src_hdr = ws.cell(hrow, upfront_col)
+    hcell.font = _Font(
+        name=src_hdr.font.name or "Calibri",
+        bold=True,
+        size=src_hdr.font.size or 11,
+    )
+
+    data_start = hrow + 1
+    data_end   = trow - 1
+
+    # 数据行：写公式，复制样式并特别保留 number_format（用于显示 $）
+    for r in range(data_start, data_end + 1):
+        mv = ws.cell(r, monthly_col).value
+        if mv is not None and (isinstance(mv, (int, float)) or (isinstance(mv, str) and mv.startswith("="))):
+            cell = ws.cell(r, yearly_col)
+            cell.value = f"={monthly_letter}{r}*12"
+            src_cell = ws.cell(r, monthly_col)
+            _copy_cell_style(src_cell, cell)
+            # 显式保留原始单元格的 number_format，以带上 $ 符号
+            if src_cell.number_format and src_cell.number_format != 'General':
+                cell.number_format = src_cell.number_format
+            else:
+                cell.number_format = '"$"#,##0.00'
+        else:
+            ws.cell(r, yearly_col).value = None
+
+    # Total 行
+    tcell = ws.cell(trow, yearly_col)
+    tcell.value = f"=SUM({yearly_letter}{data_start}:{yearly_letter}{data_end})"
+    src_total = ws.cell(trow, monthly_col)
+    _copy_cell_style(src_total, tcell)
+    if src_total.number_format and src_total.number_format != 'General':
+        tcell.number_format = src_total.number_format
+    else:
+        tcell.number_format = '"$"#,##0.00'
+    tcell.font = _Font(bold=True, name="Calibri", size=11)
+
+    ws.column_dimensions[yearly_letter].width = 22
+
+    account = _get_account_name(ws)
+    return True, "处理成功", account
+
+
+@st.fragment
+def _render_yearly_tab(budget):
+    """
+    年度价格表 Tab 与其余页面无状态依赖，放入 fragment 后
+    上传、生成、下载只重跑本函数，不再重建其它 Tab 的预览与 docx。
+    """
+    st.markdown(
+        "上传从 Azure 定价计算器导出的原始 Excel，自动新增 **Estimated yearly cost** 列（月费用 × 12）并在 Total 行汇总。"
+    )
+
+    st.divider()
+
+    uploaded_price = st.file_uploader(
+        "上传原始价格表 (.xlsx)",
+        type=["xlsx"],
+        key="upload_price_excel",
+        help="支持标准 Azure 定价计算器导出格式",
+    )
+
+    if uploaded_price is not None:
+        if st.button("生成年度价格表", type="primary", use_container_width=True, key="btn_gen_yearly"):
+            import openpyxl
+
+            try:
+                with st.spinner("正在处理 Excel..."):
+                    wb = openpyxl.load_workbook(uploaded_price)
+                    messages = []
+                    account_name = None
+                    for sname in wb.sheetnames:
+                        ok, msg, acct = _process_price_sheet(wb[sname])
+                        messages.append(f"**{sname}**: {msg}")
+                        if acct and not account_name:
+                            account_name = acct
+
+                    # 优先使用用户输入的账户名，其次使用 Excel 中提取的名称
+                    _budget = st.session_state.get("budget", budget) or "未填写"
+                    _acct_from_input = st.session_state.get("account_name") or account_name.strip()
+                    _acct_final = _acct_from_input or account_name or uploaded_price.name.replace(".xlsx", "")
+                    new_dl_name = f"{_acct_final}-Azure calculator.xlsx"
+
+                    out_buf = io.BytesIO()
+                    wb.save(out_buf)
+                    out_buf.seek(0)
+                    st.session_state["yearly_excel_bytes"] = out_buf.getvalue()
+                    st.session_state["yearly_excel_name"]  = new_dl_name
+                    st.session_state["yearly_messages"]    = messages
+
+                st.rerun(scope="fragment")
+            except Exception as e:
+                st.error(f"处理失败：{e}")
+    else:
+        st.info("请先上传 Excel 文件")
+
+    # 处理结果与下载
+    if "yearly_excel_bytes" in st.session_state:
+        st.divider()
+        for msg in st.session_state.get("yearly_messages", []):
+            st.markdown(msg)
+        st.download_button(
+            label="下载任务年度价格表 (.xlsx)",
+            data=st.session_state["yearly_excel_bytes"],
+            file_name=st.session_state["yearly_excel_name"],
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            use_container_width=True,
+            key="dl_yearly",
+        )
+
+
 # ──────────────────────────────────────────────
 # 主界面
 # ──────────────────────────────────────────────
@@ -787,11 +1816,14 @@ def main():
     if not check_secrets():
         st.stop()
 
+    # 进程首次加载时在后台预热连接与部署，不阻塞页面渲染
+    _warm_up_once(st.secrets["AZURE_OPENAI_ENDPOINT"], st.secrets["AZURE_OPENAI_DEPLOYMENT"])
+
     # 侧边栏
     with st.sidebar:
         st.markdown("### 操作")
         if st.button("清除所有结果", use_container_width=True):
-            for key in ["solution_text", "infra_text", "pov_text", "customer_name", "account_name", "csv_code", "budget", "doc_type", "yearly_excel_bytes", "yearly_excel_name", "yearly_messages"]:
+            for key in ["solution_text", "infra_text", "pov_text", "customer_name", "account_name", "csv_code", "csv_job", "draft_job", "batch_job", "budget", "doc_type", "yearly_excel_bytes", "yearly_excel_name", "yearly_messages"]:
                 st.session_state.pop(key, None)
             st.rerun()
 
@@ -806,9 +1838,9 @@ def main():
         st.markdown(f"- POV: {'OK' if pov_ok else 'Missing'}")
         st.markdown(f"- CSV: {'OK' if csv_ok else 'Missing'}")
 
-    solution_ref = extract_template_text(SOLUTION_TEMPLATE_PATH) if sol_ok else ""
-    infra_ref = extract_template_text(INFRA_TEMPLATE_PATH) if infra_ok else ""
-    pov_ref = extract_template_text(POV_TEMPLATE_PATH) if pov_ok else ""
+    solution_ref, infra_ref, pov_ref = load_template_refs(
+        SOLUTION_TEMPLATE_PATH, INFRA_TEMPLATE_PATH, POV_TEMPLATE_PATH
+    )
 
     # ════════════════════════════════════════════════════
     # 公共输入区域
@@ -839,6 +1871,15 @@ def main():
 
     dp = _date_prefix()  # 日期前缀
 
+    # 已有结果的 .docx 互不依赖：提前提交到后台线程并行构建，下载按钮处再取结果
+    docx_jobs = {}
+    deferred_downloads = []
+    if "customer_name" in st.session_state:
+        base_key = "solution_text" if st.session_state.get("doc_type", "AI") == "AI" else "infra_text"
+        for key in (base_key, "pov_text"):
+            if key in st.session_state:
+                docx_jobs[key] = _submit_docx_build(key, st.session_state["customer_name"])
+
     # ─────────── Tab 1: 解决方案文档 ───────────
     with tab_sol:
         # 文档类型切换
@@ -929,32 +1970,27 @@ def main():
                             cust = customer_name.strip() or st.session_state.get("customer_name", "未命名客户")
                             system_prompt = SOLUTION_SYSTEM_PROMPT if current_doc_type == "AI" else INFRA_SYSTEM_PROMPT
                             ref_text = solution_ref if current_doc_type == "AI" else infra_ref
-                            user_ctx = (
-                                f"## 客户信息\n- **客户名称**：{cust}\n\n"
-                            )
+                            ctx_parts = [f"## 客户信息\n- **客户名称**：{cust}\n\n"]
                             if customer_bg.strip():
-                                user_ctx += (
-                                    f"## 客户背景信息\n{customer_bg.strip()}\n\n"
-                                )
-                            user_ctx += (
+                                ctx_parts.append(f"## 客户背景信息\n{customer_bg.strip()}\n\n")
+                            ctx_parts.append(
                                 f"## 已有解决方案文档（请基于以上客户信息和以下已有文档，按照要求的章节格式重新整理生成，不要照抄原文）\n\n"
                                 f"{imported_text}"
                             )
-                            if ref_text:
-                                user_ctx += (
-                                    f"\n\n---\n\n## 【参考模板文档 —— 请学习其风格和结构，不要照抄具体数据】\n\n"
-                                    f"{ref_text}"
-                                )
+                            user_ctx = _join_prompt(ctx_parts, ref_text)
                             try:
-                                with st.spinner("正在基于导入内容 AI 重新生成..."):
-                                    result_text = call_azure_openai(system_prompt, user_ctx)
-                                    target_key = "solution_text" if current_doc_type == "AI" else "infra_text"
-                                    st.session_state[target_key] = result_text
-                                    st.session_state["customer_name"] = cust
-                                    st.session_state["account_name"] = account_name.strip() if account_name.strip() else cust
-                                    st.session_state["budget"] = budget
-                                    st.session_state.pop("pov_text", None)
-                                    st.session_state.pop("imported_doc_text", None)
+                                # 流式输出到右侧预览区
+                                with right:
+                                    result_text = st.write_stream(
+                                        stream_azure_openai(system_prompt, user_ctx, use_cache=False)
+                                    )
+                                target_key = "solution_text" if current_doc_type == "AI" else "infra_text"
+                                st.session_state[target_key] = result_text
+                                st.session_state["customer_name"] = cust
+                                st.session_state["account_name"] = account_name.strip() if account_name.strip() else cust
+                                st.session_state["budget"] = budget
+                                st.session_state.pop("pov_text", None)
+                                st.session_state.pop("imported_doc_text", None)
                                 st.rerun()
                             except Exception as e:
                                 st.error(f"生成失败：{e}")
@@ -965,32 +2001,34 @@ def main():
                         customer = st.session_state["customer_name"]
                         acct = st.session_state.get("account_name") or account_name.strip() or customer
                         if current_doc_type == "AI":
-                            docx_bytes = create_solution_docx(
-                                content=st.session_state["solution_text"], customer_name=customer
-                            )
-                            st.download_button(
+                            _docx_download_button(
+                                docx_jobs, "solution_text", customer, deferred_downloads,
                                 label="下载 AI 解决方案架构文档 (.docx)",
-                                data=docx_bytes,
                                 file_name=f"{acct}-Solution Architecture.docx",
-                                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                                 use_container_width=True,
                                 key="dl_sol_import",
                             )
                         else:
-                            docx_bytes = create_infra_docx(
-                                content=st.session_state["infra_text"], customer_name=customer
-                            )
-                            st.download_button(
+                            _docx_download_button(
+                                docx_jobs, "infra_text", customer, deferred_downloads,
                                 label="下载 Infra 基础设施架构文档 (.docx)",
-                                data=docx_bytes,
                                 file_name=f"{acct}-Infra Solution Architecture.docx",
-                                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                                 use_container_width=True,
                                 key="dl_infra_import",
                             )
 
             else:
                 # ── AI 生成文档 ──
+                use_batch = batch_mode_available() and st.checkbox(
+                    "批处理模式（费用减半，最长 24 小时返回）",
+                    key="use_batch",
+                    help="通过 Azure OpenAI Batch API 异步生成，适合不急于查看结果的场景",
+                )
+                use_drafts = not use_batch and st.checkbox(
+                    f"生成 {DRAFT_COUNT} 个候选",
+                    key="use_drafts",
+                    help="一次请求返回多个版本（输入只计费一次），挑选满意的一份采用",
+                )
                 if current_doc_type == "AI":
                     # AI 解决方案文档逻辑
                     has_solution = "solution_text" in st.session_state
@@ -1004,16 +2042,25 @@ def main():
                             st.stop()
                         try:
                             with st.spinner("正在生成 AI 解决方案架构文档..."):
-                                user_ctx = (
-                                    f"## 客户信息\n- **客户名称**：{customer_name}\n\n"
-                                    f"## 客户背景\n{customer_bg}"
+                                user_ctx = _join_prompt(
+                                    [f"## 客户信息\n- **客户名称**：{customer_name}\n\n",
+                                     f"## 客户背景\n{customer_bg}"],
+                                    solution_ref,
                                 )
-                                if solution_ref:
-                                    user_ctx += (
-                                        f"\n\n---\n\n## 【参考模板文档 —— 请学习其风格和结构，不要照抄具体数据】\n\n"
-                                        f"{solution_ref}"
+                                if use_batch:
+                                    _start_batch_job("solution_text", SOLUTION_SYSTEM_PROMPT, user_ctx,
+                                                     customer_name, account_name, budget)
+                                    st.rerun()
+                                if use_drafts:
+                                    _start_drafts("solution_text", SOLUTION_SYSTEM_PROMPT, user_ctx,
+                                                  customer_name, account_name, budget)
+                                    st.rerun()
+                                # 流式输出到右侧预览区，首个 token 到达即开始渲染
+                                with right:
+                                    sol_text = st.write_stream(
+                                        stream_azure_openai(SOLUTION_SYSTEM_PROMPT, user_ctx,
+                                                            use_cache=not has_solution)
                                     )
-                                sol_text = call_azure_openai(SOLUTION_SYSTEM_PROMPT, user_ctx)
                                 st.session_state["solution_text"] = sol_text
                                 st.session_state["customer_name"] = customer_name
                                 st.session_state["account_name"] = account_name.strip() if account_name.strip() else customer_name
@@ -1027,14 +2074,10 @@ def main():
                     if "solution_text" in st.session_state:
                         customer = st.session_state["customer_name"]
                         acct = st.session_state.get("account_name") or account_name.strip() or customer
-                        docx_sol = create_solution_docx(
-                            content=st.session_state["solution_text"], customer_name=customer
-                        )
-                        st.download_button(
+                        _docx_download_button(
+                            docx_jobs, "solution_text", customer, deferred_downloads,
                             label="下载 AI 解决方案架构文档 (.docx)",
-                            data=docx_sol,
                             file_name=f"{acct}-Solution Architecture.docx",
-                            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                             use_container_width=True,
                         )
                 else:
@@ -1050,16 +2093,24 @@ def main():
                             st.stop()
                         try:
                             with st.spinner("正在生成 Infra 基础设施架构文档..."):
-                                user_ctx = (
-                                    f"## 客户信息\n- **客户名称**：{customer_name}\n\n"
-                                    f"## 客户背景\n{customer_bg}"
+                                user_ctx = _join_prompt(
+                                    [f"## 客户信息\n- **客户名称**：{customer_name}\n\n",
+                                     f"## 客户背景\n{customer_bg}"],
+                                    infra_ref,
                                 )
-                                if infra_ref:
-                                    user_ctx += (
-                                        f"\n\n---\n\n## 【参考模板文档 —— 请学习其风格和结构，不要照抄具体数据】\n\n"
-                                        f"{infra_ref}"
+                                if use_batch:
+                                    _start_batch_job("infra_text", INFRA_SYSTEM_PROMPT, user_ctx,
+                                                     customer_name, account_name, budget)
+                                    st.rerun()
+                                if use_drafts:
+                                    _start_drafts("infra_text", INFRA_SYSTEM_PROMPT, user_ctx,
+                                                  customer_name, account_name, budget)
+                                    st.rerun()
+                                with right:
+                                    infra_text = st.write_stream(
+                                        stream_azure_openai(INFRA_SYSTEM_PROMPT, user_ctx,
+                                                            use_cache=not has_infra)
                                     )
-                                infra_text = call_azure_openai(INFRA_SYSTEM_PROMPT, user_ctx)
                                 st.session_state["infra_text"] = infra_text
                                 st.session_state["customer_name"] = customer_name
                                 st.session_state["account_name"] = account_name.strip() if account_name.strip() else customer_name
@@ -1073,43 +2124,53 @@ def main():
                     if "infra_text" in st.session_state:
                         customer = st.session_state["customer_name"]
                         acct = st.session_state.get("account_name") or account_name.strip() or customer
-                        docx_infra = create_infra_docx(
-                            content=st.session_state["infra_text"], customer_name=customer
-                        )
-                        st.download_button(
+                        _docx_download_button(
+                            docx_jobs, "infra_text", customer, deferred_downloads,
                             label="下载 Infra 基础设施架构文档 (.docx)",
-                            data=docx_infra,
                             file_name=f"{acct}-Infra Solution Architecture.docx",
-                            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                             use_container_width=True,
                         )
 
+                if use_batch or "batch_job" in st.session_state:
+                    _render_batch_panel(customer_name, account_name, budget)
+
+        draft_preview = None
+        if "draft_job" in st.session_state:
+            with left:
+                draft_preview = _render_draft_picker()
+
         with right:
-            if current_doc_type == "AI":
+            if draft_preview is not None:
+                st.markdown("**候选预览**")
+                _render_markdown_preview(draft_preview)
+            elif current_doc_type == "AI":
                 if "solution_text" in st.session_state:
                     st.markdown("**AI 解决方案文档预览**")
-                    st.markdown(st.session_state["solution_text"], unsafe_allow_html=True)
+                    _render_markdown_preview(st.session_state["solution_text"])
                 else:
                     st.info("请先生成或导入 AI 解决方案文档")
             else:
                 if "infra_text" in st.session_state:
                     st.markdown("**Infra 基础设施文档预览**")
-                    st.markdown(st.session_state["infra_text"], unsafe_allow_html=True)
+                    _render_markdown_preview(st.session_state["infra_text"])
                 else:
                     st.info("请先生成或导入 Infra 基础设施文档")
 
+    # POV / CSV 页都基于当前类型的解决方案文档：在此统一判断一次
+    current_doc_type = st.session_state.get("doc_type", "AI")
+    base_doc_key = "solution_text" if current_doc_type == "AI" else "infra_text"
+    has_base_doc = base_doc_key in st.session_state
+    base_doc_hint = "请先在「解决方案文档」标签页中生成或导入 {} 文档".format(
+        "AI 解决方案" if current_doc_type == "AI" else "Infra 基础设施"
+    )
+
     # ─────────── Tab 2: POV 部署计划 ───────────
     with tab_pov:
-        # 根据当前文档类型确定使用哪个解决方案文档
-        current_doc_type = st.session_state.get("doc_type", "AI")
-        has_base_doc = ("solution_text" in st.session_state) if current_doc_type == "AI" else ("infra_text" in st.session_state)
-        
         if not has_base_doc:
-            doc_type_name = "AI 解决方案" if current_doc_type == "AI" else "Infra 基础设施"
-            st.info(f"请先在「解决方案文档」标签页中生成或导入 {doc_type_name} 文档")
+            st.info(base_doc_hint)
         else:
             customer = st.session_state["customer_name"]
-            solution = st.session_state["solution_text"] if current_doc_type == "AI" else st.session_state["infra_text"]
+            solution = st.session_state[base_doc_key]
             left, right = st.columns([1, 1])
             with left:
                 st.caption(f"📄 当前基于: **{current_doc_type}** 解决方案文档")
@@ -1134,7 +2195,14 @@ def main():
 
                 has_pov = "pov_text" in st.session_state
                 pov_label = "重新生成" if has_pov else "生成 POV 部署计划"
-                if st.button(pov_label, type="primary", use_container_width=True, key="btn_pov"):
+                gen_pov = st.button(pov_label, type="primary", use_container_width=True, key="btn_pov")
+                # 「Migrate CSV」页已上传价格表时，可与 CSV 并行生成（两者都只依赖解决方案文档）
+                csv_excel = st.session_state.get("upload_csv_excel")
+                gen_both = csv_excel is not None and st.button(
+                    "POV + CSV 并行生成", use_container_width=True, key="btn_pov_csv",
+                    help="同时生成 POV 部署计划与「Migrate CSV」页的 Azure Migrate CSV",
+                )
+                if gen_pov or gen_both:
                     if not pov_start or not pov_end:
                         st.warning("请先选择 POV 开始日期和结束日期。")
                         st.stop()
@@ -1156,7 +2224,7 @@ def main():
                         workday_list_str = "、".join(workdays)
                         weekend_list_str = "、".join(weekends) if weekends else "无"
 
-                        pov_prompt = (
+                        pov_prompt = _join_prompt([
                             f"以下是已生成的解决方案架构文档，请据此生成 POV 部署计划：\n\n"
                             f"{solution}\n\n"
                             f"## 补充信息\n- **客户名称**：{customer}\n"
@@ -1167,80 +2235,75 @@ def main():
                             f"{weekend_list_str}\n\n"
                             f"## 乙方项目人员\n{vendor_team}\n\n"
                             f"请根据客户背景信息自动生成合理的甲方人员（2-3人，包含项目负责人和技术对接人，一定要中文名！）。"
-                        )
-                        if pov_ref:
-                            pov_prompt += (
-                                f"\n\n---\n\n## 【参考模板文档 —— 请学习其风格和结构，不要照抄具体数据】\n\n"
-                                f"{pov_ref}"
+                        ], pov_ref)
+                        csv_job = None
+                        if gen_both:
+                            migrate_csv_header = _read_migrate_csv_header()
+                            if not migrate_csv_header:
+                                st.warning("Azure Migrate CSV 模板未找到。")
+                                st.stop()
+                            csv_prompt = _build_csv_prompt(
+                                csv_excel, st.session_state.get("budget", budget), migrate_csv_header
                             )
-                        with st.spinner("正在生成 POV 部署计划..."):
-                            pov_text = call_azure_openai(POV_SYSTEM_PROMPT, pov_prompt)
-                            st.session_state["pov_text"] = pov_text
+                            # CSV 在后台线程请求，与下方 POV 的流式输出重叠
+                            csv_job = _submit_llm(call_azure_openai, CSV_SYSTEM_PROMPT, csv_prompt,
+                                                  use_cache="csv_code" not in st.session_state)
+                        # 流式输出到右侧预览区
+                        with right:
+                            pov_text = st.write_stream(
+                                stream_azure_openai(POV_SYSTEM_PROMPT, pov_prompt, use_cache=not has_pov)
+                            )
+                        st.session_state["pov_text"] = pov_text
+                        if csv_job is not None:
+                            with st.spinner("正在等待 Azure Migrate CSV..."):
+                                st.session_state["csv_code"] = _clean_csv_output(csv_job.result())
                         st.rerun()
                     except Exception as e:
                         st.error(f"生成失败：{e}")
 
                 if "pov_text" in st.session_state:
                     acct = st.session_state.get("account_name") or account_name.strip() or customer
-                    docx_pov = create_pov_docx(
-                        content=st.session_state["pov_text"], customer_name=customer
-                    )
-                    st.download_button(
+                    _docx_download_button(
+                        docx_jobs, "pov_text", customer, deferred_downloads,
                         label="下载 POV 部署计划 (.docx)",
-                        data=docx_pov,
                         file_name=f"{acct}-PostAssessment POVdeployment.docx",
-                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
                         use_container_width=True,
                     )
 
             with right:
                 if "pov_text" in st.session_state:
                     st.markdown("**文档预览**")
-                    st.markdown(st.session_state["pov_text"], unsafe_allow_html=True)
+                    _render_markdown_preview(st.session_state["pov_text"])
                 else:
                     st.info("请填写信息后点击生成")
 
     # ─────────── Tab 3: Azure Migrate CSV ───────────
     with tab_csv:
-        current_doc_type = st.session_state.get("doc_type", "AI")
-        has_base_doc = ("solution_text" in st.session_state) if current_doc_type == "AI" else ("infra_text" in st.session_state)
-        
         if not has_base_doc:
-            doc_type_name = "AI 解决方案" if current_doc_type == "AI" else "Infra 基础设施"
-            st.info(f"请先在「解决方案文档」标签页中生成或导入 {doc_type_name} 文档")
+            st.info(base_doc_hint)
         else:
             customer = st.session_state["customer_name"]
             bdgt = st.session_state.get("budget", budget)
             left, right = st.columns([1, 1])
             with left:
                 st.caption(f"📄 当前基于: **{current_doc_type}** 解决方案文档")
-
-        current_doc_type = st.session_state.get("doc_type", "AI")
-        has_base_doc = ("solution_text" in st.session_state) if current_doc_type == "AI" else ("infra_text" in st.session_state)
-        
-        if not has_base_doc:
-            doc_type_name = "AI 解决方案" if current_doc_type == "AI" else "Infra 基础设施"
-            st.info(f"请先在「解决方案文档」标签页中生成或导入 {doc_type_name} 文档")
-        else:
-            customer = st.session_state["customer_name"]
-            bdgt = st.session_state.get("budget", budget)
-            left, right = st.columns([1, 1])
-            with left:
-                st.caption(f"📄 当前基于: **{current_doc_type}** 解决方案文档")
-                migrate_csv_header = ""
-                if os.path.exists(MIGRATE_TEMPLATE_PATH):
-                    with open(MIGRATE_TEMPLATE_PATH, "r", encoding="utf-8-sig") as f:
-                        migrate_csv_header = f.readline().strip()
+                migrate_csv_header = _read_migrate_csv_header()
 
                 uploaded_excel = st.file_uploader(
                     "上传价格估算表 (.xlsx)",
                     type=["xlsx"],
+                    key="upload_csv_excel",
                     help="上传包含 Azure 资源估算金额的 Excel 文件",
                 )
 
                 has_csv = "csv_code" in st.session_state
                 csv_label = "重新生成 CSV" if has_csv else "生成 Azure Migrate CSV"
-                if st.button(csv_label, type="primary", use_container_width=True, key="btn_csv"):
+                csv_in_background = st.checkbox(
+                    "后台生成", key="csv_background",
+                    help="在后台线程中生成 CSV，期间可继续查看、下载其它页面的文档",
+                )
+                if st.button(csv_label, type="primary", use_container_width=True, key="btn_csv",
+                             disabled="csv_job" in st.session_state):
                     if not uploaded_excel:
                         st.warning("请先上传价格估算表 Excel 文件。")
                         st.stop()
@@ -1248,48 +2311,35 @@ def main():
                         st.warning("Azure Migrate CSV 模板未找到。")
                         st.stop()
                     try:
-                        import openpyxl
-                        wb = openpyxl.load_workbook(uploaded_excel, data_only=True)
-                        excel_text_parts = []
-                        for sheet_name in wb.sheetnames:
-                            ws = wb[sheet_name]
-                            rows = list(ws.iter_rows(values_only=True))
-                            if not rows:
-                                continue
-                            excel_text_parts.append(f"### Sheet: {sheet_name}")
-                            headers = [str(c) if c is not None else "" for c in rows[0]]
-                            excel_text_parts.append("| " + " | ".join(headers) + " |")
-                            excel_text_parts.append("| " + " | ".join(["---"] * len(headers)) + " |")
-                            for row in rows[1:]:
-                                cells = [str(c) if c is not None else "" for c in row]
-                                excel_text_parts.append("| " + " | ".join(cells) + " |")
-                        excel_text = "\n".join(excel_text_parts)
-
-                        csv_prompt = (
-                            f"以下是客户的 Azure 价格估算表内容：\n\n{excel_text}\n\n"
-                            f"客户预估年消耗：{bdgt}\n\n"
-                            f"Azure Migrate CSV 模板表头：\n{migrate_csv_header}\n\n"
-                            f"请根据价格估算表倒推本地 VM 配置，按模板格式生成 CSV。"
-                        )
-
-                        with st.spinner("正在生成 Azure Migrate CSV..."):
-                            csv_raw = call_azure_openai(CSV_SYSTEM_PROMPT, csv_prompt)
-                            csv_clean = csv_raw.strip()
-                            if csv_clean.startswith("```"):
-                                csv_clean = csv_clean.split("\n", 1)[1] if "\n" in csv_clean else csv_clean
-                            if csv_clean.endswith("```"):
-                                csv_clean = csv_clean[:-3].strip()
-                            st.session_state["csv_code"] = csv_clean
+                        csv_prompt = _build_csv_prompt(uploaded_excel, bdgt, migrate_csv_header)
+                        if csv_in_background:
+                            st.session_state["csv_job"] = _submit_llm(
+                                call_azure_openai, CSV_SYSTEM_PROMPT, csv_prompt, use_cache=not has_csv
+                            )
+                            st.rerun()
+                        # 流式输出到右侧预览区，生成过程中即可看到已产出的行
+                        with right:
+                            csv_raw = _stream_to_code(
+                                stream_azure_openai(CSV_SYSTEM_PROMPT, csv_prompt, use_cache=not has_csv),
+                                language="csv",
+                            )
+                        st.session_state["csv_code"] = _clean_csv_output(csv_raw)
                         st.rerun()
                     except Exception as e:
                         st.error(f"生成失败：{e}")
 
+                if "csv_job" in st.session_state:
+                    _poll_csv_job()
+                csv_job_error = st.session_state.pop("csv_job_error", None)
+                if csv_job_error:
+                    st.error(f"生成失败：{csv_job_error}")
+
                 if "csv_code" in st.session_state:
                     acct = st.session_state.get("account_name") or account_name.strip() or customer
                     csv_data = st.session_state["csv_code"]
                     st.download_button(
                         label="下载 Azure Migrate CSV",
-                        data=csv_data.encode("utf-8-sig"),
+                        data=partial(_csv_download_bytes, csv_data),
                         file_name=f"{acct}-Azure migrate report.csv",
                         mime="text/csv",
                         use_container_width=True,
@@ -1300,23 +2350,8 @@ def main():
                     csv_data = st.session_state["csv_code"]
                     st.markdown("**CSV 预览**")
                     try:
-                        import csv as csv_mod
-                        csv_lines = csv_data.strip().split("\n")
-                        reader = csv_mod.reader(csv_lines)
-                        all_rows = list(reader)
-                        if len(all_rows) > 1:
-                            header = all_rows[0]
-                            num_cols = len(header)
-                            # 对齐列数：补齐或截断
-                            data_rows = []
-                            for row in all_rows[1:]:
-                                if len(row) < num_cols:
-                                    row = row + [""] * (num_cols - len(row))
-                                elif len(row) > num_cols:
-                                    row = row[:num_cols]
-                                data_rows.append(row)
-                            import pandas as pd
-                            df = pd.DataFrame(data_rows, columns=header)
+                        df = _csv_preview_frame(csv_data)
+                        if df is not None:
                             st.dataframe(df, use_container_width=True)
                     except Exception as e:
                         st.warning(f"预览失败，请使用下载查看: {e}")
@@ -1327,168 +2362,10 @@ def main():
 
     # ─────────── Tab 4: 年度价格表 ───────────
     with tab_yearly:
-        st.markdown(
-            "上传从 Azure 定价计算器导出的原始 Excel，自动新增 **Estimated yearly cost** 列（月费用 × 12）并在 Total 行汇总。"
-        )
+        _render_yearly_tab(budget)
 
-        st.divider()
-
-        uploaded_price = st.file_uploader(
-            "上传原始价格表 (.xlsx)",
-            type=["xlsx"],
-            key="upload_price_excel",
-            help="支持标准 Azure 定价计算器导出格式",
-        )
-
-        if uploaded_price is not None:
-            if st.button("生成年度价格表", type="primary", use_container_width=True, key="btn_gen_yearly"):
-                import openpyxl
-                from copy import copy as _copy
-                from openpyxl.styles import Font as _Font
-
-                def _col_letter(n):
-                    result = ""
-                    while n:
-                        n, rem = divmod(n - 1, 26)
-                        result = chr(65 + rem) + result
-                    return result
-
-                def _copy_cell_style(src, dst):
-                    if src.has_style:
-                        dst.font      = _copy(src.font)
-                        dst.fill      = _copy(src.fill)
-                        dst.border    = _copy(src.border)
-                        dst.alignment = _copy(src.alignment)
-                        dst.number_format = src.number_format
-
-                def _find_header_row(ws):
-                    for i, row in enumerate(ws.iter_rows(values_only=True), 1):
-                        if row and "Estimated monthly cost" in row:
-                            return i
-                    return None
-
-                def _find_total_row(ws, hrow):
-                    for i, row in enumerate(ws.iter_rows(min_row=hrow + 1, values_only=True), hrow + 1):
-                        if row and "Total" in row:
-                            return i
-                    return None
-
-                def _get_account_name(ws):
-                    """从 Sheet 第 2 行前 5 列取账号名（非空的第一个值）。"""
-                    for col in range(1, 6):
-                        v = ws.cell(2, col).value
-                        if v and str(v).strip():
-                            return str(v).strip().rstrip("\t").strip()
-                    return None
-
-                def _process_sheet(ws):
-                    hrow = _find_header_row(ws)
-                    if hrow is None:
-                        return False, "未找到标题行（含 'Estimated monthly cost'）", None
-                    trow = _find_total_row(ws, hrow)
-                    if trow is None:
-                        return False, "未找到 Total 行", None
-
-                    header_vals = [ws.cell(hrow, c).value for c in range(1, ws.max_column + 1)]
-                    try:
-                        monthly_col = header_vals.index("Estimated monthly cost") + 1
-                        upfront_col = header_vals.index("Estimated upfront cost") + 1
-                    except ValueError:
-                        return False, "未找到必要列名", None
-
-                    yearly_col     = upfront_col + 1
-                    ws.insert_cols(yearly_col)
-                    monthly_letter = _col_letter(monthly_col)
-                    yearly_letter  = _col_letter(yearly_col)
-
-                    # 标题行：复制 upfront 列样式
-                    hcell = ws.cell(hrow, yearly_col, "Estimated yearly cost")
-                    _copy_cell_style(ws.cell(hrow, upfront_col), hcell)
-                    src_hdr = ws.cell(hrow, upfront_col)
-                    hcell.font = _Font(
-                        name=src_hdr.font.name or "Calibri",
-                        bold=True,
-                        size=src_hdr.font.size or 11,
-                    )
-
-                    data_start = hrow + 1
-                    data_end   = trow - 1
-
-                    # 数据行：写公式，复制样式并特别保留 number_format（用于显示 $）
-                    for r in range(data_start, data_end + 1):
-                        mv = ws.cell(r, monthly_col).value
-                        if mv is not None and (isinstance(mv, (int, float)) or (isinstance(mv, str) and mv.startswith("="))):
-                            cell = ws.cell(r, yearly_col)
-                            cell.value = f"={monthly_letter}{r}*12"
-                            src_cell = ws.cell(r, monthly_col)
-                            _copy_cell_style(src_cell, cell)
-                            # 显式保留原始单元格的 number_format，以带上 $ 符号
-                            if src_cell.number_format and src_cell.number_format != 'General':
-                                cell.number_format = src_cell.number_format
-                            else:
-                                cell.number_format = '"$"#,##0.00'
-                        else:
-                            ws.cell(r, yearly_col).value = None
-
-                    # Total 行
-                    tcell = ws.cell(trow, yearly_col)
-                    tcell.value = f"=SUM({yearly_letter}{data_start}:{yearly_letter}{data_end})"
-                    src_total = ws.cell(trow, monthly_col)
-                    _copy_cell_style(src_total, tcell)
-                    if src_total.number_format and src_total.number_format != 'General':
-                        tcell.number_format = src_total.number_format
-                    else:
-                        tcell.number_format = '"$"#,##0.00'
-                    tcell.font = _Font(bold=True, name="Calibri", size=11)
-
-                    ws.column_dimensions[yearly_letter].width = 22
-                    
-                    account = _get_account_name(ws)
-                    return True, "处理成功", account
-
-                try:
-                    with st.spinner("正在处理 Excel..."):
-                        wb = openpyxl.load_workbook(uploaded_price)
-                        messages = []
-                        account_name = None
-                        for sname in wb.sheetnames:
-                            ok, msg, acct = _process_sheet(wb[sname])
-                            messages.append(f"**{sname}**: {msg}")
-                            if acct and not account_name:
-                                account_name = acct
-
-                        # 优先使用用户输入的账户名，其次使用 Excel 中提取的名称
-                        _budget = st.session_state.get("budget", budget) or "未填写"
-                        _acct_from_input = st.session_state.get("account_name") or account_name.strip()
-                        _acct_final = _acct_from_input or account_name or uploaded_price.name.replace(".xlsx", "")
-                        new_dl_name = f"{_acct_final}-Azure calculator.xlsx"
-
-                        out_buf = io.BytesIO()
-                        wb.save(out_buf)
-                        out_buf.seek(0)
-                        st.session_state["yearly_excel_bytes"] = out_buf.getvalue()
-                        st.session_state["yearly_excel_name"]  = new_dl_name
-                        st.session_state["yearly_messages"]    = messages
-
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"处理失败：{e}")
-        else:
-            st.info("请先上传 Excel 文件")
-
-        # 处理结果与下载
-        if "yearly_excel_bytes" in st.session_state:
-            st.divider()
-            for msg in st.session_state.get("yearly_messages", []):
-                st.markdown(msg)
-            st.download_button(
-                label="下载任务年度价格表 (.xlsx)",
-                data=st.session_state["yearly_excel_bytes"],
-                file_name=st.session_state["yearly_excel_name"],
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                use_container_width=True,
-                key="dl_yearly",
-            )
+    # 尚未构建完成的 .docx 下载按钮：其余内容都已渲染，此时再等待
+    _flush_deferred_downloads(deferred_downloads)
 
 
 # ──────────────────────────────────────────────